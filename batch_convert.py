@@ -0,0 +1,182 @@
+"""
+Convert whole directories (or globs) of .dat files to PNG and PNG files to .dat, spread across several processes
+.dat -> PNG writes design.dat.png next to the file (same as python-dat-viewer.py), PNG -> .dat writes design.dat next to design.png
+with -o the outputs go under that directory instead, laid out like the input directories
+"""
+import argparse
+import contextlib
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import grid_generator
+import profiling
+from dat_codec import DatImage
+from dat_reader import stream_to_png
+
+
+def output_path_for(input_path: str, output_dir: str = None, input_root: str = None) -> str:
+    """
+    :param input_path: A .dat or .png file.
+    :param output_dir: Directory to put the output in, None for next to the input.
+    :param input_root: Directory the inputs were collected from, the input's path under it is mirrored under output_dir
+                       (so a/x.dat and b/x.dat don't both end up as output_dir/x.dat.png). None to keep just the file name.
+    :return: Where the converted file goes.
+    """
+    if input_path.lower().endswith('.dat'):
+        output_path = input_path + '.png'
+    else:
+        output_path = os.path.splitext(input_path)[0] + '.dat'
+
+    if output_dir is not None:
+        if input_root is None:
+            output_path = os.path.join(output_dir, os.path.basename(output_path))
+        else:
+            output_path = os.path.join(output_dir, os.path.relpath(os.path.abspath(output_path), input_root))
+    return output_path
+
+
+def common_root(input_paths: list) -> str:
+    """:return: The deepest directory all the inputs are under, None if they don't share one (e.g. different drives)."""
+    try:
+        return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in input_paths])
+    except ValueError:
+        return None
+
+
+def collect_inputs(patterns: list, recursive: bool = False) -> list:
+    """
+    Expand directories and globs into a sorted list of .dat and .png files.
+    PNGs named *.dat.png are renders of .dat files, so they are left out to avoid converting them back over their own source.
+
+    :param patterns: Files, directories or glob patterns.
+    :param recursive: Also look in subdirectories of any directories given.
+    :return: The input files, without duplicates.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for extension in ('dat', 'png'):
+                paths.update(glob.glob(os.path.join(pattern, '**' if recursive else '', f'*.{extension}'), recursive=recursive))
+        else:
+            paths.update(glob.glob(pattern, recursive=recursive))
+
+    return sorted(path for path in paths
+                  if os.path.isfile(path)
+                  and path.lower().endswith(('.dat', '.png'))
+                  and not path.lower().endswith('.dat.png'))
+
+
+def is_up_to_date(input_path: str, output_path: str) -> bool:
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+
+def convert_file(input_path: str, output_path: str, quantize: bool = False, compact: str = None, target_palette: list = None) -> tuple:
+    """
+    Convert a single file, run in a worker process.
+
+    :param input_path: The .dat or .png file to convert.
+    :param output_path: Where to write the result.
+    :param quantize: Map PNG colors that aren't in the palette to the nearest one instead of failing.
+    :param compact: For PNG -> .dat, None to write the full palette, 'index' or 'frequency' to only write the colors that are used.
+    :param target_palette: For PNG -> .dat with compact, a machine palette (list of (r, g, b)) to line the used colors up with.
+    :return: (input path, output path, seconds taken, pixel count, profiling records of this conversion).
+    """
+    start = time.perf_counter()
+    # the encode/decode functions print sizes as they go, which is just noise with thousands of files
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if input_path.lower().endswith('.dat'):
+            # streamed a block of rows at a time, so tall designs don't have to be decoded whole
+            width, height = stream_to_png(input_path, output_path)
+            pixels = width * height
+        else:
+            color_indices = grid_generator.find_matching_pixels(input_path, quantize)
+            grid_generator.generate_dat_from_color_indices(color_indices, output_path, compact, target_palette)
+            pixels = color_indices.size
+    # the worker exits without printing its own profile, so the stages go back to the parent with the result
+    return input_path, output_path, time.perf_counter() - start, pixels, profiling.take_records()
+
+
+def convert_all(input_paths: list, output_dir: str = None, workers: int = None, force: bool = False, quantize: bool = False,
+                compact: str = None, target_palette: list = None) -> dict:
+    """
+    Convert a list of files across a process pool, printing the time each file took and a throughput summary at the end.
+
+    :param input_paths: The .dat and .png files to convert.
+    :param output_dir: Directory to put the outputs in, None for next to each input. Subdirectories of the inputs are mirrored under it.
+    :param workers: Number of worker processes, None for one per CPU.
+    :param force: Convert even if the output is newer than the input.
+    :param quantize: Map PNG colors that aren't in the palette to the nearest one instead of failing.
+    :param compact: For PNG -> .dat, None to write the full palette, 'index' or 'frequency' to only write the colors that are used.
+    :param target_palette: For PNG -> .dat with compact, a machine palette (list of (r, g, b)) to line the used colors up with.
+    :return: Counts of converted, skipped, conflicting and failed files plus total pixels and seconds.
+    """
+    summary = {'converted': 0, 'skipped': 0, 'conflicts': 0, 'failed': 0, 'pixels': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+
+    input_root = common_root(input_paths) if output_dir is not None and input_paths else None
+    inputs = {os.path.normcase(os.path.abspath(input_path)) for input_path in input_paths}
+    jobs = []
+    for input_path in input_paths:
+        output_path = output_path_for(input_path, output_dir, input_root)
+        if os.path.normcase(os.path.abspath(output_path)) in inputs:
+            # e.g. design.png -> design.dat next to a source design.dat, which another worker may be reading, even with force
+            summary['conflicts'] += 1
+            print(f"SKIPPED {input_path}: {output_path} is one of the inputs, not overwriting it")
+        elif not force and is_up_to_date(input_path, output_path):
+            summary['skipped'] += 1
+        else:
+            jobs.append((input_path, output_path))
+
+    if output_dir is not None:
+        for output_subdir in {os.path.dirname(output_path) for _, output_path in jobs}:
+            os.makedirs(output_subdir, exist_ok=True)
+
+    initializer, initargs = profiling.worker_initializer()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        futures = {executor.submit(convert_file, input_path, output_path, quantize, compact, target_palette): input_path for input_path, output_path in jobs}
+        for future in as_completed(futures):
+            try:
+                input_path, output_path, seconds, pixels, records = future.result()
+            except Exception as e:
+                summary['failed'] += 1
+                print(f"FAILED {futures[future]}: {e}")
+                continue
+            profiling.add_records(records)
+            summary['converted'] += 1
+            summary['pixels'] += pixels
+            print(f"{input_path} -> {output_path} ({pixels} px, {seconds * 1000:.1f} ms)")
+
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    seconds = summary['seconds'] or 1e-9
+    print(f"converted {summary['converted']}, skipped {summary['skipped']} (up to date), {summary['conflicts']} would overwrite an input, "
+          f"failed {summary['failed']} in {summary['seconds']:.2f} s")
+    print(f"throughput: {summary['converted'] / seconds:.1f} files/s, {summary['pixels'] / seconds / 1e6:.2f} Mpx/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert .dat files to PNG and PNG files to .dat in bulk")
+    parser.add_argument("inputs", nargs="+", help="files, directories or glob patterns to convert")
+    parser.add_argument("-o", "--output-dir", help="directory to write the converted files to (default: next to each input)")
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="look in subdirectories too")
+    parser.add_argument("-f", "--force", action="store_true", help="convert even if the output is already up to date")
+    parser.add_argument("-q", "--quantize", action="store_true", help="map PNG colors that aren't in the palette to the nearest one instead of failing")
+    parser.add_argument("-c", "--compact", choices=["index", "frequency"], help="only write the palette colors a PNG uses, in index or most-used-first order")
+    parser.add_argument("-t", "--target-palette", help="with --compact, a .dat file whose palette the used colors should line up with")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.target_palette and not args.compact:
+        parser.error("--target-palette only does something with --compact, pick --compact index or --compact frequency")
+    profiling.from_args(args)
+
+    # the machine palette is read once here and handed to every worker
+    target_palette = DatImage.load(args.target_palette).color_list() if args.target_palette else None
+    summary = convert_all(collect_inputs(args.inputs, args.recursive), args.output_dir, args.workers, args.force, args.quantize,
+                          args.compact, target_palette)
+    print_summary(summary)
@@ -0,0 +1,232 @@
+"""
+Benchmarks for the .dat encode/decode paths, run on synthetic designs so nothing has to be checked in
+each path is timed on solid, striped and noisy jacquard inputs of a few sizes, and the results (seconds, pixels/sec, peak memory)
+are printed as a table and written to a JSON file so runs from different releases can be compared
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import colors
+import grid_generator
+from dat_codec import DatImage, encode_rle_rows
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# color indices to draw synthetic designs from, only indices whose color isn't also at a lower index so PNGs convert back to the same indices
+USABLE_COLOR_INDICES = np.array(sorted(set(colors.color_index_lookup.values())), dtype=np.uint8)
+
+
+def load_script(name: str, relative_path: str):
+    """
+    Import one of the hyphenated scripts (e.g. python-dat-viewer.py) as a module.
+
+    :return: The module, or None if it (or one of its dependencies) can't be imported here.
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError:
+        return None
+    return module
+
+
+def solid_design(width: int, height: int, rng: np.random.Generator) -> np.ndarray:
+    """:return: A single color design, one run per row."""
+    return np.full((height, width), rng.choice(USABLE_COLOR_INDICES), dtype=np.uint8)
+
+
+def striped_design(width: int, height: int, rng: np.random.Generator, stripe_width: int = 8) -> np.ndarray:
+    """:return: Vertical stripes of a few colors, width / stripe_width runs per row."""
+    stripe_colors = rng.choice(USABLE_COLOR_INDICES, size=4)
+    return np.broadcast_to(stripe_colors[(np.arange(width) // stripe_width) % len(stripe_colors)], (height, width)).copy()
+
+
+def jacquard_design(width: int, height: int, rng: np.random.Generator, mean_run: float = 3.0) -> np.ndarray:
+    """:return: Noisy jacquard, rows of short runs with geometrically distributed lengths (mean_run stitches on average)."""
+    # runs are drawn in batches until they cover the whole canvas, a single batch sized for the mean can come up short
+    batches = []
+    covered = 0
+    while covered < width * height:
+        batch = rng.geometric(1 / mean_run, size=(width * height - covered) // max(int(mean_run), 1) + width)
+        batches.append(batch)
+        covered += int(batch.sum())
+    run_lengths = np.concatenate(batches)
+    run_colors = rng.choice(USABLE_COLOR_INDICES[:8], size=len(run_lengths))
+    return np.repeat(run_colors, run_lengths)[:width * height].reshape(height, width)
+
+
+DESIGNS = {
+    'solid': solid_design,
+    'striped': striped_design,
+    'jacquard': jacquard_design
+}
+
+
+def write_synthetic_inputs(grid: np.ndarray, directory: str, name: str) -> tuple:
+    """
+    Write a design out as a .dat file, a PNG using the colors.py palette, and a lossy JPEG of the PNG (for quantizing).
+
+    :param grid: Color indices, first row is the top of the image.
+    :return: (dat path, png path, jpeg path).
+    """
+    dat = DatImage(grid.shape[1], grid.shape[0],
+                   colors.red_values, colors.green_values, colors.blue_values,
+                   grid[::-1].tobytes())
+    dat_path = os.path.join(directory, name + '.dat')
+    png_path = os.path.join(directory, name + '.png')
+    jpeg_path = os.path.join(directory, name + '.jpg')
+    dat.save(dat_path)
+    rgb_image = dat.to_image().convert('RGB')
+    rgb_image.save(png_path)
+    rgb_image.save(jpeg_path, quality=85)
+    return dat_path, png_path, jpeg_path
+
+
+def measure(function, repeats: int) -> tuple:
+    """
+    Run function once under tracemalloc for its peak memory, then repeats more times for the timings, all with its printing silenced.
+    The memory pass isn't timed, tracing every allocation slows the run down too much for its time to mean anything.
+
+    :return: (best wall time in seconds of the timed runs, peak traced memory in bytes of the memory pass).
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return min(times), peak
+
+
+def benchmark_paths(grid: np.ndarray, dat_path: str, png_path: str, jpeg_path: str, output_dir: str) -> dict:
+    """
+    :return: The encode/decode paths to time for one design, name -> zero argument function.
+    """
+    paths = {
+        'DatImage.load': lambda: DatImage.load(dat_path),
+        'DatImage.save': lambda: DatImage.load(dat_path).save(os.path.join(output_dir, 'resave.dat')),
+        'generate_dat_from_color_indices': lambda: grid_generator.generate_dat_from_color_indices(grid, os.path.join(output_dir, 'generated.dat')),
+        'find_matching_pixels': lambda: grid_generator.find_matching_pixels(png_path),
+        'find_matching_pixels_quantize': lambda: grid_generator.find_matching_pixels(jpeg_path, quantize=True)
+    }
+
+    viewer = load_script('python_dat_viewer', 'python-dat-viewer.py')
+    if viewer is not None:
+        paths['decode_dat_to_image'] = lambda: viewer.decode_dat_to_image(dat_path, os.path.join(output_dir, 'decoded.png'))
+        paths['stream_dat_to_png'] = lambda: viewer.stream_dat_to_png(dat_path, os.path.join(output_dir, 'streamed.png'))
+
+    content_viewer = load_script('file_content_viewer', os.path.join('half baked', 'file-content-viewer.py'))
+    if content_viewer is not None:
+        paths['parse_dat'] = lambda: content_viewer.parse_dat(dat_path)
+
+    # the editor opens a pygame window, so it's only benchmarked where pygame is installed (with a dummy video driver)
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    editor = load_script('dat_editor', os.path.join('half baked', 'dat-editor.py'))
+    if editor is not None:
+        canvas = editor.PixelCanvas.from_file(dat_path, 1)
+        save_path = os.path.join(output_dir, 'editor.dat')
+
+        def save_all_rows():
+            # first save after opening: every row is RLE encoded
+            canvas.row_rle = [None] * canvas.height
+            canvas.save_canvas_to_file(save_path)
+
+        def save_one_row():
+            # save after an edit to a single row: every other row comes from the RLE cache
+            canvas.row_rle[canvas.height // 2] = None
+            canvas.save_canvas_to_file(save_path)
+
+        paths['save_canvas_to_file'] = save_all_rows
+        paths['save_canvas_to_file_one_row'] = save_one_row
+
+    return paths
+
+
+def run_benchmarks(sizes: list, designs: list, repeats: int = 3, only: list = None, seed: int = 0) -> list:
+    """
+    :param sizes: (width, height) pairs to generate designs at.
+    :param designs: Names from DESIGNS.
+    :param repeats: How many times to time each path, the best time is kept.
+    :param only: Only run paths with these names, None for all.
+    :param seed: Random seed for the synthetic designs.
+    :return: One result dict per (design, size, path).
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in sizes:
+            for design in designs:
+                grid = DESIGNS[design](width, height, rng)
+                dat_path, png_path, jpeg_path = write_synthetic_inputs(grid, directory, f'{design}_{width}x{height}')
+                run_count = len(encode_rle_rows(grid)) // 2
+
+                for path_name, function in benchmark_paths(grid, dat_path, png_path, jpeg_path, directory).items():
+                    if only and path_name not in only:
+                        continue
+                    seconds, peak_memory = measure(function, repeats)
+                    results.append({
+                        'path': path_name,
+                        'design': design,
+                        'width': width,
+                        'height': height,
+                        'runs': run_count,
+                        'seconds': seconds,
+                        'pixels_per_second': width * height / seconds if seconds else None,
+                        'peak_memory_bytes': peak_memory
+                    })
+    return results
+
+
+def print_results(results: list) -> None:
+    print(f"{'path':<32} {'design':<9} {'size':>11} {'runs':>9} {'ms':>10} {'Mpx/s':>9} {'peak MiB':>9}")
+    for result in results:
+        size = f"{result['width']}x{result['height']}"
+        print(f"{result['path']:<32} {result['design']:<9} {size:>11} {result['runs']:>9} {result['seconds'] * 1000:>10.2f} "
+              f"{(result['pixels_per_second'] or 0) / 1e6:>9.2f} {result['peak_memory_bytes'] / (1 << 20):>9.2f}")
+
+
+def parse_size(size: str) -> tuple:
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark the .dat encode/decode paths on synthetic designs")
+    parser.add_argument("-s", "--sizes", nargs="+", type=parse_size, default=[(200, 300), (1000, 1500)], help="design sizes as WIDTHxHEIGHT")
+    parser.add_argument("-d", "--designs", nargs="+", choices=sorted(DESIGNS), default=sorted(DESIGNS), help="synthetic designs to run")
+    parser.add_argument("-p", "--paths", nargs="+", help="only run these paths (e.g. parse_dat find_matching_pixels)")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="timed runs per path, the best time is kept (plus one untimed run for memory)")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON file to write the results to")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic designs")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.designs, args.repeats, args.paths, args.seed)
+    print_results(results)
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results
+        }, file, indent=2)
+    print(f"results written to {args.output}")
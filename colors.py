@@ -1,22 +1,76 @@
 """color lists to use to generate a .dat file"""
 
-# create a list of bytes containing the red color components to be written out to the .dat file
-red_color_byte_list = [b'\xff', b'\x00', b'\xff', b'\x00', b'\xff', b'\x00', b'\xff', b'\x00', b'l', b'J', b'\xff', b'\xb4', b'\x99', b'\x90', b'\x80', b'\xcf', b'R', b'Q', b'\xeb', b'\x00', b'\xfc', b'\xb2', b'\xfc', b'\xfc', b'\xfc', b'\xfc', b'd', b'\xd8', b'\xeb', b'\xa0', b'\x90', b's', b'\x9d', b's', b'\xd8', b'\xeb', b'\xff', b'\xb4', b'\xac', b'\xd7', b'\xd8', b'\x7f', b'\xd8', b'\x90', b'\xca', b'\xd8', b'\xae', b'\xbc', b'\x80', b'\x9f', b'\xff', b'\xdc', b'\xfc', b'\xc0', b'\xd8', b'\xfc', b'\x90', b'\xff', b'\xfd', b'\xb4', b'\x00', b'\xa0', b'2', b'2', b'\x00', b'5', b'\xd8', b'\xd8', b'\xa8', b'\xc0', b'\xff', b'\x99', b'\xb7', b'\x00', b'\xe2', b'\xc5', b'\x90', b'\xc0', b'\x90', b'\x90', b'J', b'\x00', b'\x90', b'm', b'\x00', b'\x00', b'f', b'3', b'\x85', b'\x99', b'x', b'\xca', b'\xb4', b'\x90', b'}', b'\xff', b'\xff', b'\xff', b'\x7f', b'i', b'\xfa', b'\x81', b'\xfc', b'\xac', b'\x7f', b'\xb2', b'\xb4', b'\xb4', b'\xb4', b'\xd4', b'\xff', b'\x90', b'\xff', b'\xc0', b'\xc0', b's', b'\xd8', b'\xa9', b'\xbf', b'\xb4', b'\xff', b'\x90', b'\xd8', b'\xb2', b'\xaa', b'\x00', b'\xd8', b'\x00', b'\xfb', b'\x90', b'\x81', b'\x9d', b'7', b'\xac', b'\xdd', b'\xbf', b'\xb9', b'?', b'\xef', b'\xd7', b'\xde', b'\xfd', b'\xfe', b's', b'/', b'\x8d', b'\xfb', b'\xff', b'\xfe', b'\xed', b'\x06', b'\xf5', b'\xea', b'\xed', b'\xad', b'=', b'\xfc', b'\xfa', b'\xef', b'\xfd', b'f', b'\x8d', b'\x7f', b'z', b'_', b'y', b'\x9b', b'q', b'\xff', b'\xee', b'\xa8', b'\xff', b'\x9f', b'\xdb', b'\xf5', b'\xff', b'\xcd', b'\xf3', b'\xe0', b'\xfe', b'\xc8', b'y', b's', b'\x1f', b'\xbf', b'\xe5', b'\xf3', b'\xf6', b'\xe0', b'\xde', b'\xf0', b'\xcc', b'K', b'd', b'@', b'\xa1', b'\xf7', b'\x1a', b'\xe0', b'g', b'\xff', b'd', b'\xf5', b'?', b'\x97', b'\xef', b'\x14', b'\x96', b'\xd7', b'g', b'\xb7', b'\xee', b'\xba', b'\xea', b'l', b'\xbd', b'&', b'N', b'd', b'/', b'\xbf', b'\x9f', b'\x7f', b'\xf3', b'\xaa', b'\xff', b'\xe6', b'\xbf', b'W', b'\xeb', b'\x06', b'\xfe', b'O', b'\xed', b'j', b'\xef', b'b', b'\xb7', b'\xdd', b'\xcf', b'f', b'k', b'\xb2', b'z', b'Z', b'\xf7', b'\x9c', b'L', b'\x96', b'\x9d', b'\x00', b'\x00', b'n', b'\xc8', b'\x00', b'd']
+# the 256 color palette exactly as it is written to a .dat file: 256 red bytes (0x200), then 256 green (0x300), then 256 blue (0x400)
+# everything else in this module is built from this table the first time it's used, so importing colors costs next to nothing
+PALETTE_TABLE = bytes.fromhex(
+    'ff00ff00ff00ff006c4affb4999080cf5251eb00fcb2fcfcfcfc64d8eba09073'
+    '9d73d8ebffb4acd7d87fd890cad8aebc809fffdcfcc0d8fc90fffdb400a03232'
+    '0035d8d8a8c0ff99b700e2c590c090904a00906d00006633859978cab4907dff'
+    'ffff7f69fa81fcac7fb2b4b4b4d4ff90ffc0c073d8a9bfb4ff90d8b2aa00d800'
+    'fb90819d37acddbfb93fefd7defdfe732f8dfbfffeed06f5eaedad3dfcfaeffd'
+    '668d7f7a5f799b71ffeea8ff9fdbf5ffcdf3e0fec879731fbfe5f3f6e0def0cc'
+    '4b6440a1f71ae067ff64f53f97ef1496d767b7eebaea6cbd264e642fbf9f7ff3'
+    'aaffe6bf57eb06fe4fed6aef62b7ddcf666bb27a5af79c4c969d00006ec80064'
+    '0000ffff0000ffff248967b4996c809091ffeb7cb4766c94b4d8c890ac66d873'
+    '7fb2d8eb00b4acc34800d86ca7b48d9a607f9076fcfffcfcff90eb90ffffcae9'
+    'd5af6c6c5460ff66bca0c5aecfffb4d88970c0a59966c1ad7ad630286c488f00'
+    '9966003fa364d8eb7fb26c90d895bf6ccfcf90b2d8e56ad8ddd8b47300009d96'
+    'fd65df5a9dacf3dff76effdbfffbfbab31c7faaf6aaf039dfeea0c9fdea7f57d'
+    '00c7ff67bf7f7f87fccebf2f6fbebafdf25f2ddfc87f5bb5776f8fdb927ef05f'
+    'ff9d40baf7ec6dfb646496e3c7f7d3ffaf7ff5f673f7b25a5f8889b7bcfd7fe9'
+    '7f7e2ffa7cf703a5c7eafb8dffff795b00e78d67b9ec59f700bd96af00007d64'
+    '00000000ffffffff9099bdd899b4ffc0dbde24916cb24863fcfcc8fceb0048b2'
+    '017348aca06cebe1907ffcd8e1d8f546ffff9075b4904890c0cfc790ffffe9e9'
+    '00edb4d8b4b4ffffbca0b2b7c0cffcfc9999cfb4ffffffff03ff9c91d8b4a58f'
+    'd2bb0024b90c6cac00736c48d895bf6c9090cfb2b4e76990adfc6c73007f4900'
+    'fefda56f7fff7bbeab1167ffb9559d7ffbde7f7f7ffbf093fefbebbfef5df7fc'
+    '8adeff963abddfbbf83db0cf9efe5ffdf3d9ff93c8bdaa37fd817fbeff7ff091'
+    '4b4c404b67ceffa97dff64d36ff7b4f7adcffce9cd7f81af64f751f5a47ddf3f'
+    'cff7fdf97fdff04d5ffbfffb4fdfa9f08a45ba96fcbd09b700f2000000000064'
+)
 
-red_color_bytes = bytearray().join(red_color_byte_list)
 
-# create a list of bytes containing the green color components to be written out to the .dat file
-green_color_byte_list = [b'\x00', b'\x00', b'\xff', b'\xff', b'\x00', b'\x00', b'\xff', b'\xff', b'$', b'\x89', b'g', b'\xb4', b'\x99', b'l', b'\x80', b'\x90', b'\x91', b'\xff', b'\xeb', b'|', b'\xb4', b'v', b'l', b'\x94', b'\xb4', b'\xd8', b'\xc8', b'\x90', b'\xac', b'f', b'\xd8', b's', b'\x7f', b'\xb2', b'\xd8', b'\xeb', b'\x00', b'\xb4', b'\xac', b'\xc3', b'H', b'\x00', b'\xd8', b'l', b'\xa7', b'\xb4', b'\x8d', b'\x9a', b'`', b'\x7f', b'\x90', b'v', b'\xfc', b'\xff', b'\xfc', b'\xfc', b'\xff', b'\x90', b'\xeb', b'\x90', b'\xff', b'\xff', b'\xca', b'\xe9', b'\xd5', b'\xaf', b'l', b'l', b'T', b'`', b'\xff', b'f', b'\xbc', b'\xa0', b'\xc5', b'\xae', b'\xcf', b'\xff', b'\xb4', b'\xd8', b'\x89', b'p', b'\xc0', b'\xa5', b'\x99', b'f', b'\xc1', b'\xad', b'z', b'\xd6', b'0', b'(', b'l', b'H', b'\x8f', b'\x00', b'\x99', b'f', b'\x00', b'?', b'\xa3', b'd', b'\xd8', b'\xeb', b'\x7f', b'\xb2', b'l', b'\x90', b'\xd8', b'\x95', b'\xbf', b'l', b'\xcf', b'\xcf', b'\x90', b'\xb2', b'\xd8', b'\xe5', b'j', b'\xd8', b'\xdd', b'\xd8', b'\xb4', b's', b'\x00', b'\x00', b'\x9d', b'\x96', b'\xfd', b'e', b'\xdf', b'Z', b'\x9d', b'\xac', b'\xf3', b'\xdf', b'\xf7', b'n', b'\xff', b'\xdb', b'\xff', b'\xfb', b'\xfb', b'\xab', b'1', b'\xc7', b'\xfa', b'\xaf', b'j', b'\xaf', b'\x03', b'\x9d', b'\xfe', b'\xea', b'\x0c', b'\x9f', b'\xde', b'\xa7', b'\xf5', b'}', b'\x00', b'\xc7', b'\xff', b'g', b'\xbf', b'\x7f', b'\x7f', b'\x87', b'\xfc', b'\xce', b'\xbf', b'/', b'o', b'\xbe', b'\xba', b'\xfd', b'\xf2', b'_', b'-', b'\xdf', b'\xc8', b'\x7f', b'[', b'\xb5', b'w', b'o', b'\x8f', b'\xdb', b'\x92', b'~', b'\xf0', b'_', b'\xff', b'\x9d', b'@', b'\xba', b'\xf7', b'\xec', b'm', b'\xfb', b'd', b'd', b'\x96', b'\xe3', b'\xc7', b'\xf7', b'\xd3', b'\xff', b'\xaf', b'\x7f', b'\xf5', b'\xf6', b's', b'\xf7', b'\xb2', b'Z', b'_', b'\x88', b'\x89', b'\xb7', b'\xbc', b'\xfd', b'\x7f', b'\xe9', b'\x7f', b'~', b'/', b'\xfa', b'|', b'\xf7', b'\x03', b'\xa5', b'\xc7', b'\xea', b'\xfb', b'\x8d', b'\xff', b'\xff', b'y', b'[', b'\x00', b'\xe7', b'\x8d', b'g', b'\xb9', b'\xec', b'Y', b'\xf7', b'\x00', b'\xbd', b'\x96', b'\xaf', b'\x00', b'\x00', b'}', b'd']
+def _build(name):
+    # red/green/blue_color_byte_list: each color chunk in file order as a list of single byte bytes objects
+    if name in ('red_color_byte_list', 'green_color_byte_list', 'blue_color_byte_list'):
+        start = ('red_color_byte_list', 'green_color_byte_list', 'blue_color_byte_list').index(name) * 0x100
+        return [bytes((value,)) for value in PALETTE_TABLE[start:start + 0x100]]
+    # red/green/blue_color_bytes: each color chunk in file order (what gets written out to the .dat file)
+    if name == 'red_color_bytes':
+        return bytearray(PALETTE_TABLE[0x000:0x100])
+    if name == 'green_color_bytes':
+        return bytearray(PALETTE_TABLE[0x100:0x200])
+    if name == 'blue_color_bytes':
+        return bytearray(PALETTE_TABLE[0x200:0x300])
+    # red/green/blue_values: each color chunk byte swapped into color index order (what the RLE data's color indices point at)
+    # the codec (and numpy/PIL with it) is only imported once one of these is asked for, so a bare import of colors stays cheap
+    if name in ('red_values', 'green_values', 'blue_values'):
+        from dat_codec import byte_swap
+        start = ('red_values', 'green_values', 'blue_values').index(name) * 0x100
+        return bytes(byte_swap(PALETTE_TABLE[start:start + 0x100]))
+    # (r, g, b) tuples in file order, before the bytes are swapped
+    if name == 'color_list_preflip':
+        return list(zip(PALETTE_TABLE[0x000:0x100], PALETTE_TABLE[0x100:0x200], PALETTE_TABLE[0x200:0x300]))
+    # color list to be used to generate .dat file's RLE data (color indices)
+    if name == 'color_list':
+        return list(zip(_get('red_values'), _get('green_values'), _get('blue_values')))
+    # '#rrggbb' strings in color index order
+    if name == 'hex_list':
+        return ['#{:02x}{:02x}{:02x}'.format(*color) for color in _get('color_list')]
+    # reverse lookup from an (r, g, b) tuple to its color index, so matching a color doesn't scan the whole list
+    # a few colors are in the list twice, the lowest index wins (same as color_list.index)
+    if name == 'color_index_lookup':
+        return {color: index for index, color in reversed(list(enumerate(_get('color_list'))))}
+    raise AttributeError(f"module 'colors' has no attribute '{name}'")
 
-green_color_bytes = bytearray().join(green_color_byte_list)
 
-# create a list of bytes containing the green color components to be written out to the .dat file
-blue_color_byte_list = [b'\x00', b'\x00', b'\x00', b'\x00', b'\xff', b'\xff', b'\xff', b'\xff', b'\x90', b'\x99', b'\xbd', b'\xd8', b'\x99', b'\xb4', b'\xff', b'\xc0', b'\xdb', b'\xde', b'$', b'\x91', b'l', b'\xb2', b'H', b'c', b'\xfc', b'\xfc', b'\xc8', b'\xfc', b'\xeb', b'\x00', b'H', b'\xb2', b'\x01', b's', b'H', b'\xac', b'\xa0', b'l', b'\xeb', b'\xe1', b'\x90', b'\x7f', b'\xfc', b'\xd8', b'\xe1', b'\xd8', b'\xf5', b'F', b'\xff', b'\xff', b'\x90', b'u', b'\xb4', b'\x90', b'H', b'\x90', b'\xc0', b'\xcf', b'\xc7', b'\x90', b'\xff', b'\xff', b'\xe9', b'\xe9', b'\x00', b'\xed', b'\xb4', b'\xd8', b'\xb4', b'\xb4', b'\xff', b'\xff', b'\xbc', b'\xa0', b'\xb2', b'\xb7', b'\xc0', b'\xcf', b'\xfc', b'\xfc', b'\x99', b'\x99', b'\xcf', b'\xb4', b'\xff', b'\xff', b'\xff', b'\xff', b'\x03', b'\xff', b'\x9c', b'\x91', b'\xd8', b'\xb4', b'\xa5', b'\x8f', b'\xd2', b'\xbb', b'\x00', b'$', b'\xb9', b'\x0c', b'l', b'\xac', b'\x00', b's', b'l', b'H', b'\xd8', b'\x95', b'\xbf', b'l', b'\x90', b'\x90', b'\xcf', b'\xb2', b'\xb4', b'\xe7', b'i', b'\x90', b'\xad', b'\xfc', b'l', b's', b'\x00', b'\x7f', b'I', b'\x00', b'\xfe', b'\xfd', b'\xa5', b'o', b'\x7f', b'\xff', b'{', b'\xbe', b'\xab', b'\x11', b'g', b'\xff', b'\xb9', b'U', b'\x9d', b'\x7f', b'\xfb', b'\xde', b'\x7f', b'\x7f', b'\x7f', b'\xfb', b'\xf0', b'\x93', b'\xfe', b'\xfb', b'\xeb', b'\xbf', b'\xef', b']', b'\xf7', b'\xfc', b'\x8a', b'\xde', b'\xff', b'\x96', b':', b'\xbd', b'\xdf', b'\xbb', b'\xf8', b'=', b'\xb0', b'\xcf', b'\x9e', b'\xfe', b'_', b'\xfd', b'\xf3', b'\xd9', b'\xff', b'\x93', b'\xc8', b'\xbd', b'\xaa', b'7', b'\xfd', b'\x81', b'\x7f', b'\xbe', b'\xff', b'\x7f', b'\xf0', b'\x91', b'K', b'L', b'@', b'K', b'g', b'\xce', b'\xff', b'\xa9', b'}', b'\xff', b'd', b'\xd3', b'o', b'\xf7', b'\xb4', b'\xf7', b'\xad', b'\xcf', b'\xfc', b'\xe9', b'\xcd', b'\x7f', b'\x81', b'\xaf', b'd', b'\xf7', b'Q', b'\xf5', b'\xa4', b'}', b'\xdf', b'?', b'\xcf', b'\xf7', b'\xfd', b'\xf9', b'\x7f', b'\xdf', b'\xf0', b'M', b'_', b'\xfb', b'\xff', b'\xfb', b'O', b'\xdf', b'\xa9', b'\xf0', b'\x8a', b'E', b'\xba', b'\x96', b'\xfc', b'\xbd', b'\t', b'\xb7', b'\x00', b'\xf2', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'd']
+def _get(name):
+    # module level __getattr__ isn't used for names looked up from inside the module, so go through this instead
+    return globals()[name] if name in globals() else __getattr__(name)
 
-blue_color_bytes = bytearray().join(blue_color_byte_list)
 
-# color list to be used to generate .dat file's RLE data (color indices)
-# in order to get the color indices to be right, the bytes have to be swapped from the original list
-color_list_preflip = [(255, 0, 0), (0, 0, 0), (255, 255, 0), (0, 255, 0), (255, 0, 255), (0, 0, 255), (255, 255, 255), (0, 255, 255), (108, 36, 144), (74, 137, 153), (255, 103, 189), (180, 180, 216), (153, 153, 153), (144, 108, 180), (128, 128, 255), (207, 144, 192), (82, 145, 219), (81, 255, 222), (235, 235, 36), (0, 124, 145), (252, 180, 108), (178, 118, 178), (252, 108, 72), (252, 148, 99), (252, 180, 252), (252, 216, 252), (100, 200, 200), (216, 144, 252), (235, 172, 235), (160, 102, 0), (144, 216, 72), (115, 115, 178), (157, 127, 1), (115, 178, 115), (216, 216, 72), (235, 235, 172), (255, 0, 160), (180, 180, 108), (172, 172, 235), (215, 195, 225), (216, 72, 144), (127, 0, 127), (216, 216, 252), (144, 108, 216), (202, 167, 225), (216, 180, 216), (174, 141, 245), (188, 154, 70), (128, 96, 255), (159, 127, 255), (255, 144, 144), (220, 118, 117), (252, 252, 180), (192, 255, 144), (216, 252, 72), (252, 252, 144), (144, 255, 192), (255, 144, 207), (253, 235, 199), (180, 144, 144), (0, 255, 255), (160, 255, 255), (50, 202, 233), (50, 233, 233), (0, 213, 0), (53, 175, 237), (216, 108, 180), (216, 108, 216), (168, 84, 180), (192, 96, 180), (255, 255, 255), (153, 102, 255), (183, 188, 188), (0, 160, 160), (226, 197, 178), (197, 174, 183), (144, 207, 192), (192, 255, 207), (144, 180, 252), (144, 216, 252), (74, 137, 153), (0, 112, 153), (144, 192, 207), (109, 165, 180), (0, 153, 255), (0, 102, 255), (102, 193, 255), (51, 173, 255), (133, 122, 3), (153, 214, 255), (120, 48, 156), (202, 40, 145), (180, 108, 216), (144, 72, 180), (125, 143, 165), (255, 0, 143), (255, 153, 210), (255, 102, 187), (127, 0, 0), (105, 63, 36), (250, 163, 185), (129, 100, 12), (252, 216, 108), (172, 235, 172), (127, 127, 0), (178, 178, 115), (180, 108, 108), (180, 144, 72), (180, 216, 216), (212, 149, 149), (255, 191, 191), (144, 108, 108), (255, 207, 144), (192, 207, 144), (192, 144, 207), (115, 178, 178), (216, 216, 180), (169, 229, 231), (191, 106, 105), (180, 216, 144), (255, 221, 173), (144, 216, 252), (216, 180, 108), (178, 115, 115), (170, 0, 0), (0, 0, 127), (216, 157, 73), (0, 150, 0), (251, 253, 254), (144, 101, 253), (129, 223, 165), (157, 90, 111), (55, 157, 127), (172, 172, 255), (221, 243, 123), (191, 223, 190), (185, 247, 171), (63, 110, 17), (239, 255, 103), (215, 219, 255), (222, 255, 185), (253, 251, 85), (254, 251, 157), (115, 171, 127), (47, 49, 251), (141, 199, 222), (251, 250, 127), (255, 175, 127), (254, 106, 127), (237, 175, 251), (6, 3, 240), (245, 157, 147), (234, 254, 254), (237, 234, 251), (173, 12, 235), (61, 159, 191), (252, 222, 239), (250, 167, 93), (239, 245, 247), (253, 125, 252), (102, 0, 138), (141, 199, 222), (127, 255, 255), (122, 103, 150), (95, 191, 58), (121, 127, 189), (155, 127, 223), (113, 135, 187), (255, 252, 248), (238, 206, 61), (168, 191, 176), (255, 47, 207), (159, 111, 158), (219, 190, 254), (245, 186, 95), (255, 253, 253), (205, 242, 243), (243, 95, 217), (224, 45, 255), (254, 223, 147), (200, 200, 200), (121, 127, 189), (115, 91, 170), (31, 181, 55), (191, 119, 253), (229, 111, 129), (243, 143, 127), (246, 219, 190), (224, 146, 255), (222, 126, 127), (240, 240, 240), (204, 95, 145), (75, 255, 75), (100, 157, 76), (64, 64, 64), (161, 186, 75), (247, 247, 103), (26, 236, 206), (224, 109, 255), (103, 251, 169), (255, 100, 125), (100, 100, 255), (245, 150, 100), (63, 227, 211), (151, 199, 111), (239, 247, 247), (20, 211, 180), (150, 255, 247), (215, 175, 173), (103, 127, 207), (183, 245, 252), (238, 246, 233), (186, 115, 205), (234, 247, 127), (108, 178, 129), (189, 90, 175), (38, 95, 100), (78, 136, 247), (100, 137, 81), (47, 183, 245), (191, 188, 164), (159, 253, 125), (127, 127, 223), (243, 233, 63), (170, 127, 207), (255, 126, 247), (230, 47, 253), (191, 250, 249), (87, 124, 127), (235, 247, 223), (6, 3, 240), (254, 165, 77), (79, 199, 95), (237, 234, 251), (106, 251, 255), (239, 141, 251), (98, 255, 79), (183, 255, 223), (221, 121, 169), (207, 91, 240), (102, 0, 138), (107, 231, 69), (178, 141, 186), (122, 103, 150), (90, 185, 252), (247, 236, 189), (156, 89, 9), (76, 247, 183), (150, 0, 0), (157, 189, 242), (0, 150, 0), (0, 175, 0), (110, 0, 0), (200, 0, 0), (0, 125, 0), (100, 100, 100)]
-
-color_list = [color for pair in zip(color_list_preflip[1::2], color_list_preflip[::2]) for color in pair]
+def __getattr__(name):
+    # only called for names that haven't been built yet, once built they're kept as normal module globals
+    value = _build(name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,408 @@
+"""
+Shared reading and writing of .dat files for shima knitting machines, so the viewer, the grid generator and the editor all go through the same code
+layout notes are in dat_info.md
+"""
+import numpy as np
+from PIL import Image
+
+import profiling
+
+# header layout (all little endian shorts)
+MIN_X_OFFSET = 0x000
+MIN_Y_OFFSET = 0x002
+MAX_X_OFFSET = 0x004
+MAX_Y_OFFSET = 0x006
+MAGIC_A_OFFSET = 0x008
+MAGIC_B_OFFSET = 0x010
+MAGIC_NUMBER = 1000
+MAX_COORDINATE = 0xFFFF # the bounds are unsigned shorts, so min + size - 1 has to fit in one
+
+# palette is 256 red values, then 256 green, then 256 blue, each chunk with its bytes swapped in pairs
+PALETTE_OFFSET = 0x200
+PALETTE_SIZE = 0x100
+
+# RLE raster data (color index, repeat count) starts here and runs to the end of the file
+RASTER_OFFSET = 0x600
+MAX_REPEAT = 255
+
+# single byte objects for each color index, so runs can be filled with one multiply + slice assignment
+SINGLE_BYTES = [bytes((i,)) for i in range(256)]
+
+
+def byte_swap(arr) -> bytearray:
+    """
+    Swap each pair of bytes, used to convert the palette chunks between the order in the file and the order of the color indices.
+
+    :param arr: The bytes to swap, must be an even length.
+    :return: A new bytearray with every pair of bytes swapped.
+    """
+    # two slice assignments instead of a python loop over every byte
+    ret = bytearray(len(arr))
+    ret[0::2] = arr[1::2]
+    ret[1::2] = arr[0::2]
+    return ret
+
+
+def expand_rle(raster_data, pixel_count: int) -> bytearray:
+    """
+    Expand the RLE raster data (pairs of color index, repeat count) into a flat buffer of color indices.
+
+    :param raster_data: The raw bytes from 0x600 to the end of the file.
+    :param pixel_count: Number of pixels in the canvas (width * height), anything past this is ignored.
+    :return: A bytearray of color indices, one per pixel, starting from the bottom-left corner.
+    """
+    indices = bytearray(pixel_count) # pixels not covered by the raster data stay at color index 0
+    pairs = np.frombuffer(raster_data, dtype=np.uint8, count=len(raster_data) // 2 * 2)
+    color_indices, repeat_counts = pairs[0::2], pairs[1::2]
+
+    # runs past the one that fills the canvas are dropped and that one is cut to fit, then a single np.repeat expands the rest
+    run_ends = np.cumsum(repeat_counts, dtype=np.int64)
+    last = int(np.searchsorted(run_ends, pixel_count, side='left'))
+    if last < len(run_ends):
+        color_indices = color_indices[:last + 1]
+        repeat_counts = repeat_counts[:last + 1].copy()
+        repeat_counts[-1] -= run_ends[last] - pixel_count
+    covered = int(run_ends[min(last, len(run_ends) - 1)]) if len(run_ends) else 0
+    np.frombuffer(indices, dtype=np.uint8)[:min(covered, pixel_count)] = np.repeat(color_indices, repeat_counts)
+    return indices
+
+
+def encode_rle(indices, width: int, height: int) -> bytes:
+    """
+    RLE encode a flat buffer of color indices.
+
+    :param indices: A flat buffer of color indices (width * height long) starting from the bottom-left corner.
+    :param width: Width of the canvas.
+    :param height: Height of the canvas.
+    :return: The raster data to write at 0x600.
+    """
+    return encode_rle_rows(np.frombuffer(indices, dtype=np.uint8).reshape(height, width))
+
+
+def encode_rle_rows(grid: np.ndarray) -> bytes:
+    """
+    RLE encode a 2-D array of color indices one row at a time, so runs never cross the end of a row and runs longer than 255 are split.
+    Run boundaries are found with array diffs rather than walking each pixel.
+
+    :param grid: A 2-D uint8 array of color indices where the first row is the bottom row of the canvas.
+    :return: The raster data to write at 0x600.
+    """
+    height, width = grid.shape
+    if width == 0 or height == 0:
+        return b''
+
+    # a run starts at the beginning of every row and wherever the color changes from the pixel to its left
+    run_starts = np.ones((height, width), dtype=bool)
+    run_starts[:, 1:] = grid[:, 1:] != grid[:, :-1]
+    starts = np.flatnonzero(run_starts)
+    return encode_runs(grid.ravel()[starts], np.diff(starts, append=height * width))
+
+
+def encode_runs(values: np.ndarray, lengths: np.ndarray) -> bytes:
+    """
+    Write out runs of any length as RLE pairs.
+
+    :param values: The color index of each run.
+    :param lengths: The length of each run, runs longer than 255 are split and zero length runs are dropped.
+    :return: The raster data to write at 0x600.
+    """
+    keep = lengths > 0
+    values, lengths = values[keep], lengths[keep]
+
+    # runs longer than 255 become several full 255 pairs followed by one pair with whatever is left over
+    pieces = (lengths + MAX_REPEAT - 1) // MAX_REPEAT
+    repeats = np.full(int(pieces.sum()), MAX_REPEAT, dtype=np.uint8)
+    repeats[np.cumsum(pieces) - 1] = lengths - MAX_REPEAT * (pieces - 1)
+
+    raster_data = np.empty(2 * len(repeats), dtype=np.uint8)
+    raster_data[0::2] = np.repeat(values, pieces)
+    raster_data[1::2] = repeats
+    return raster_data.tobytes()
+
+
+class DatImage:
+    """
+    A .dat file in memory: the header values, the 256 color palette and the color index of every pixel.
+
+    The palette is kept in color index order (already byte swapped), so color index i is (palette_r[i], palette_g[i], palette_b[i]).
+    Pixels are kept in a flat bytearray in the same order as the raster data, so the first row is the bottom row of the canvas.
+    """
+
+    def __init__(self, width: int, height: int, palette_r=None, palette_g=None, palette_b=None, indices=None, min_x: int = 0, min_y: int = 0):
+        self.width = width
+        self.height = height
+        self.min_x = min_x
+        self.min_y = min_y
+        self.magic_a = MAGIC_NUMBER
+        self.magic_b = MAGIC_NUMBER
+        self.palette_r = bytearray(palette_r) if palette_r is not None else bytearray(PALETTE_SIZE)
+        self.palette_g = bytearray(palette_g) if palette_g is not None else bytearray(PALETTE_SIZE)
+        self.palette_b = bytearray(palette_b) if palette_b is not None else bytearray(PALETTE_SIZE)
+        self.indices = bytearray(indices) if indices is not None else bytearray(width * height)
+
+        if len(self.indices) != width * height:
+            raise ValueError(f"Expected {width * height} color indices, got {len(self.indices)}.")
+
+    @classmethod
+    def load(cls, file_path: str) -> 'DatImage':
+        """
+        Read a .dat file with a single read and decode its raster.
+
+        :param file_path: Path to the .dat file.
+        :return: The decoded DatImage, magic numbers are kept as read so callers can decide what to do if they are wrong.
+        """
+        with open(file_path, 'rb') as file, profiling.stage('dat read') as stage:
+            data = file.read()
+            stage['bytes_read'] = len(data)
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data) -> 'DatImage':
+        """
+        Decode the contents of a .dat file.
+
+        :param data: The whole file as bytes.
+        :return: The decoded DatImage.
+        """
+        with profiling.stage('header+palette'):
+            header = read_header(data)
+            palette_r, palette_g, palette_b = read_palette(data)
+        pixel_count = header['width'] * header['height']
+        with profiling.stage('rle expand', runs=max(len(data) - RASTER_OFFSET, 0) // 2, pixels=pixel_count):
+            indices = expand_rle(memoryview(data)[RASTER_OFFSET:], pixel_count)
+
+        dat = cls(header['width'], header['height'], palette_r, palette_g, palette_b, indices, header['min_x'], header['min_y'])
+        dat.magic_a = header['magic_a']
+        dat.magic_b = header['magic_b']
+        return dat
+
+    def to_bytes(self) -> bytearray:
+        """
+        Encode this image in the .dat layout.
+
+        :return: The full file contents.
+        """
+        data = self.header_bytes()
+        with profiling.stage('rle encode', pixels=len(self.indices)) as stage:
+            raster_data = encode_rle(self.indices, self.width, self.height)
+            stage['runs'] = len(raster_data) // 2
+        data += raster_data
+        return data
+
+    def header_bytes(self) -> bytearray:
+        """
+        Encode everything before the raster data (header values and palette).
+
+        :return: The first 0x600 bytes of the file.
+        """
+        return build_header(self.width, self.height, self.palette_r, self.palette_g, self.palette_b,
+                            self.min_x, self.min_y, self.magic_a, self.magic_b)
+
+    def save(self, file_path: str) -> None:
+        """
+        Write this image out as a .dat file with a single write.
+
+        :param file_path: The path to the output file, ending in .dat.
+        """
+        data = self.to_bytes()
+        with open(file_path, 'wb') as file, profiling.stage('dat write', bytes_written=len(data)):
+            file.write(data)
+
+    def color_list(self) -> list:
+        """
+        :return: The palette as a list of 256 (r, g, b) tuples, in color index order.
+        """
+        return list(zip(self.palette_r, self.palette_g, self.palette_b))
+
+    def hex_palette(self) -> list:
+        """
+        :return: The palette as a list of 256 '#rrggbb' strings, in color index order.
+        """
+        return ["#{:02x}{:02x}{:02x}".format(*color) for color in self.color_list()]
+
+    def rgb_palette(self) -> bytearray:
+        """
+        :return: The palette as 768 interleaved r, g, b bytes, the format PIL's putpalette expects.
+        """
+        return interleave_palette(self.palette_r, self.palette_g, self.palette_b)
+
+    def color_counts(self) -> np.ndarray:
+        """
+        :return: How many pixels use each color index, 256 counts from a single bincount over the index buffer.
+        """
+        return np.bincount(np.frombuffer(self.indices, dtype=np.uint8), minlength=PALETTE_SIZE)
+
+    def remap(self, translation, palette_r, palette_g, palette_b) -> 'DatImage':
+        """
+        Move every pixel to a new color index with a 256 entry translation table, in one bytes.translate pass over the index buffer.
+
+        :param translation: 256 bytes, translation[old index] is the new index.
+        :param palette_r: 256 red values of the new palette, in new index order.
+        :param palette_g: 256 green values of the new palette.
+        :param palette_b: 256 blue values of the new palette.
+        :return: A new DatImage with the same header values.
+        """
+        dat = DatImage(self.width, self.height, palette_r, palette_g, palette_b, self.indices.translate(bytes(translation)), self.min_x, self.min_y)
+        dat.magic_a = self.magic_a
+        dat.magic_b = self.magic_b
+        return dat
+
+    def compacted(self, order: str = 'index', target_palette: list = None) -> 'DatImage':
+        """
+        Rebuild the palette from only the colors that are drawn, merging palette entries that hold the same color.
+        Entries past the used colors are left black.
+
+        :param order: 'index' keeps the used colors in their current index order, 'frequency' puts the most used color at index 0.
+        :param target_palette: A machine palette as a list of (r, g, b) tuples, used colors that are in it go to its index for that color,
+                               the rest take the first slots past the end of it (then any of its slots this design doesn't use)
+                               and every slot that isn't taken keeps the target's color.
+        :return: A new DatImage with the compacted palette and the pixels remapped to it.
+        """
+        counts = self.color_counts()
+        used = np.flatnonzero(counts)
+        if order == 'frequency':
+            used = used[np.argsort(-counts[used], kind='stable')]
+        elif order != 'index':
+            raise ValueError(f"Unknown palette order {order!r}, expected 'index' or 'frequency'.")
+
+        palette = self.color_list()
+        new_palette = list(target_palette or [])[:PALETTE_SIZE]
+        new_palette += [(0, 0, 0)] * (PALETTE_SIZE - len(new_palette))
+        target_lookup = {}
+        for index, color in reversed(list(enumerate(target_palette or []))): # lowest index wins if a color is in the target twice
+            target_lookup[color] = index
+
+        # colors that are in the target palette keep the target's index, so slots for the others are only handed out after those are claimed
+        slots = {} # color -> new index
+        for index in used:
+            color = palette[index]
+            if color in target_lookup:
+                slots[color] = target_lookup[color]
+        claimed = set(slots.values())
+        free_slots = iter([index for index in range(len(target_palette or []), PALETTE_SIZE)]
+                          + [index for index in range(len(target_palette or [])) if index not in claimed])
+
+        translation = bytearray(range(PALETTE_SIZE)) # indices no pixel uses can go anywhere
+        for index in used:
+            color = palette[index]
+            if color not in slots:
+                slots[color] = next(free_slots)
+                new_palette[slots[color]] = color
+            translation[index] = slots[color]
+
+        palette_r, palette_g, palette_b = zip(*new_palette)
+        return self.remap(translation, palette_r, palette_g, palette_b)
+
+    def to_image(self) -> Image.Image:
+        """
+        Build a palette ("P" mode) PIL image, flipped so the bottom row of the raster is the bottom of the image.
+
+        :return: The PIL image.
+        """
+        with profiling.stage('image build', pixels=len(self.indices)):
+            img = Image.frombytes('P', (self.width, self.height), bytes(self.indices))
+            img.putpalette(self.rgb_palette())
+            return img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+
+
+def build_header(width: int, height: int, palette_r, palette_g, palette_b, min_x: int = 0, min_y: int = 0,
+                 magic_a: int = MAGIC_NUMBER, magic_b: int = MAGIC_NUMBER) -> bytearray:
+    """
+    Encode the header values and palette, for writers that don't have a whole DatImage (e.g. ones that only hold runs).
+
+    :param palette_r: 256 red values in color index order, swapped into file order here.
+    :param palette_g: 256 green values.
+    :param palette_b: 256 blue values.
+    :return: The first 0x600 bytes of the file.
+    """
+    data = bytearray(RASTER_OFFSET)
+    write_short(data, MIN_X_OFFSET, min_x)
+    write_short(data, MIN_Y_OFFSET, min_y)
+    write_short(data, MAX_X_OFFSET, min_x + width - 1)
+    write_short(data, MAX_Y_OFFSET, min_y + height - 1)
+    write_short(data, MAGIC_A_OFFSET, magic_a)
+    write_short(data, MAGIC_B_OFFSET, magic_b)
+
+    data[PALETTE_OFFSET:PALETTE_OFFSET + PALETTE_SIZE] = byte_swap(palette_r)
+    data[PALETTE_OFFSET + PALETTE_SIZE:PALETTE_OFFSET + 2 * PALETTE_SIZE] = byte_swap(palette_g)
+    data[PALETTE_OFFSET + 2 * PALETTE_SIZE:PALETTE_OFFSET + 3 * PALETTE_SIZE] = byte_swap(palette_b)
+    return data
+
+
+def read_header(data) -> dict:
+    """
+    Read the header values from the start of a .dat file.
+
+    :param data: The file contents (at least the first 0x012 bytes).
+    :return: A dict with min_x, min_y, width, height, magic_a and magic_b.
+    """
+    min_x = read_short(data, MIN_X_OFFSET)
+    min_y = read_short(data, MIN_Y_OFFSET)
+    return {
+        'min_x': min_x,
+        'min_y': min_y,
+        'width': read_short(data, MAX_X_OFFSET) - min_x + 1,
+        'height': read_short(data, MAX_Y_OFFSET) - min_y + 1,
+        'magic_a': read_short(data, MAGIC_A_OFFSET),
+        'magic_b': read_short(data, MAGIC_B_OFFSET)
+    }
+
+
+def read_palette(data) -> tuple:
+    """
+    Read the palette chunks at 0x200, 0x300 and 0x400 and swap them into color index order.
+
+    :param data: The file contents (at least the first 0x500 bytes).
+    :return: The red, green and blue values as three 256 byte bytearrays.
+    """
+    return (byte_swap(data[PALETTE_OFFSET:PALETTE_OFFSET + PALETTE_SIZE]),
+            byte_swap(data[PALETTE_OFFSET + PALETTE_SIZE:PALETTE_OFFSET + 2 * PALETTE_SIZE]),
+            byte_swap(data[PALETTE_OFFSET + 2 * PALETTE_SIZE:PALETTE_OFFSET + 3 * PALETTE_SIZE]))
+
+
+def read_runs(data, pixel_count: int) -> tuple:
+    """
+    :param data: The whole file (bytes or an mmap).
+    :param pixel_count: width * height from the header.
+    :return: (run ends, color indices), run ends are the pixel count up to the end of each run, capped at pixel_count.
+             A last run of color index 0 is added to cover whatever the RLE data leaves uncovered, same as expand_rle.
+    """
+    pair_count = max(len(data) - RASTER_OFFSET, 0) // 2
+    pairs = np.frombuffer(data, dtype=np.uint8, count=2 * pair_count, offset=RASTER_OFFSET)
+    run_ends = np.minimum(np.cumsum(pairs[1::2], dtype=np.int64), pixel_count)
+    return np.append(run_ends, pixel_count), np.append(pairs[0::2], np.uint8(0))
+
+
+def row_segments(run_ends: np.ndarray, run_colors: np.ndarray, width: int, height: int) -> tuple:
+    """
+    Cut the runs wherever a row ends, so every piece is inside a single row.
+
+    :param run_ends: Run ends from read_runs.
+    :param run_colors: Color indices from read_runs.
+    :return: (row, color index, length) arrays, one entry per piece in raster order, zero length runs dropped.
+    """
+    ends = np.union1d(run_ends, np.arange(1, height + 1, dtype=np.int64) * width)
+    starts = np.concatenate(([0], ends[:-1]))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    colors = run_colors[np.searchsorted(run_ends, starts, side='right')]
+    return starts // width, colors, ends - starts
+
+
+def interleave_palette(palette_r, palette_g, palette_b) -> bytearray:
+    """
+    :return: The three palette chunks as 768 interleaved r, g, b bytes (the format PIL's putpalette and PNG's PLTE expect).
+    """
+    palette = bytearray(3 * PALETTE_SIZE)
+    palette[0::3] = palette_r
+    palette[1::3] = palette_g
+    palette[2::3] = palette_b
+    return palette
+
+
+def read_short(data, offset: int) -> int:
+    return int.from_bytes(data[offset:offset + 2], 'little')
+
+
+def write_short(data: bytearray, offset: int, value: int) -> None:
+    data[offset:offset + 2] = value.to_bytes(2, 'little')
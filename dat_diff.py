@@ -0,0 +1,231 @@
+"""
+Diff two .dat files without decoding either raster
+the two RLE streams are merged run by run (every run boundary in either file starts a new segment, and inside a segment both files
+have a single color), so the work scales with the number of runs rather than the number of stitches
+rows are numbered like the raster data, row 0 is the bottom row of the canvas
+"""
+import argparse
+import json
+import mmap
+import sys
+
+import numpy as np
+from PIL import Image
+
+from dat_codec import read_header, read_palette, read_runs
+from dat_reader import DatReader
+
+# how much of the old color is kept for stitches that didn't change in the overlay, the rest is faded to white
+OVERLAY_FADE = 0.25
+
+
+def changed_segments(runs_a: tuple, runs_b: tuple, keys_a: np.ndarray, keys_b: np.ndarray) -> tuple:
+    """
+    Merge two run lists and find where they differ.
+
+    :param runs_a: (run ends, color indices) of the old file, from read_runs.
+    :param runs_b: (run ends, color indices) of the new file.
+    :param keys_a: What each of the old file's 256 color indices is compared by (e.g. its packed RGB value, or the index itself).
+    :param keys_b: The same for the new file.
+    :return: (starts, ends) of the stretches of stitches that changed, in raster order.
+    """
+    ends_a, colors_a = runs_a
+    ends_b, colors_b = runs_b
+    ends = np.union1d(ends_a, ends_b)
+    starts = np.concatenate(([0], ends[:-1]))
+
+    # the run a segment falls in is the first run that ends after the segment starts
+    old = keys_a[colors_a[np.searchsorted(ends_a, starts, side='right')]]
+    new = keys_b[colors_b[np.searchsorted(ends_b, starts, side='right')]]
+    changed = (old != new) & (ends > starts)
+    return starts[changed], ends[changed]
+
+
+def row_extents(starts: np.ndarray, ends: np.ndarray, width: int, height: int) -> tuple:
+    """
+    Work out the leftmost and rightmost changed stitch of every row from the changed segments, without expanding them.
+
+    :return: (leftmost x, rightmost x) arrays with one entry per row, rows with no changes have leftmost width and rightmost -1.
+    """
+    left = np.full(height, width, dtype=np.int64)
+    right = np.full(height, -1, dtype=np.int64)
+    last = ends - 1
+    first_rows, last_rows = starts // width, last // width
+
+    # the row a segment starts in is changed from where it starts, the row it ends in up to where it ends,
+    # and a segment that wraps onto another row covers the rest of its first row and the start of its last
+    wraps = last_rows > first_rows
+    np.minimum.at(left, first_rows, starts % width)
+    np.maximum.at(right, first_rows, np.where(wraps, width - 1, last % width))
+    np.minimum.at(left, last_rows, np.where(wraps, 0, starts % width))
+    np.maximum.at(right, last_rows, last % width)
+
+    # rows strictly between the first and last row of a segment changed all the way across
+    covered = np.zeros(height + 1, dtype=np.int64)
+    np.add.at(covered, first_rows[wraps] + 1, 1)
+    np.add.at(covered, last_rows[wraps], -1)
+    full_rows = np.cumsum(covered[:-1]) > 0
+    left[full_rows] = 0
+    right[full_rows] = width - 1
+    return left, right
+
+
+def bounding_boxes(left: np.ndarray, right: np.ndarray) -> list:
+    """
+    :return: One box per band of consecutive changed rows, as dicts of x, y (bottom row of the band), width and height.
+    """
+    changed_rows = np.flatnonzero(right >= 0)
+    if not len(changed_rows):
+        return []
+    band_starts = np.flatnonzero(np.diff(changed_rows, prepend=-2) > 1)
+    boxes = []
+    for band in np.split(changed_rows, band_starts[1:]):
+        x = int(left[band].min())
+        boxes.append({
+            'x': x,
+            'y': int(band[0]),
+            'width': int(right[band].max()) - x + 1,
+            'height': len(band)
+        })
+    return boxes
+
+
+def row_ranges(rows) -> list:
+    """:return: Sorted row numbers collapsed into [first, last] ranges."""
+    ranges = []
+    for row in rows:
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ranges
+
+
+def packed_palette(data) -> np.ndarray:
+    """:return: Each of the 256 palette entries as a packed 0xRRGGBB value."""
+    palette_r, palette_g, palette_b = (np.frombuffer(bytes(chunk), dtype=np.uint8).astype(np.uint32) for chunk in read_palette(data))
+    return (palette_r << 16) | (palette_g << 8) | palette_b
+
+
+def diff_bytes(old_data, new_data, by_index: bool = False) -> dict:
+    """
+    Compare the contents of two .dat files.
+
+    :param old_data: The old file (bytes or an mmap).
+    :param new_data: The new file.
+    :param by_index: Compare the color index of each stitch rather than the color it shows, so moving a color to another palette slot counts as a change.
+    :return: A report dict with header, palette and stitch changes, stitch changes are left out if the canvases aren't the same size.
+    """
+    old_header, new_header = read_header(old_data), read_header(new_data)
+    old_palette, new_palette = packed_palette(old_data), packed_palette(new_data)
+
+    report = {
+        'header_changes': {name: [old_header[name], new_header[name]] for name in old_header if old_header[name] != new_header[name]},
+        'palette_changes': [{'index': int(index), 'old': f'#{old_palette[index]:06x}', 'new': f'#{new_palette[index]:06x}'}
+                            for index in np.flatnonzero(old_palette != new_palette)],
+        'same_size': (old_header['width'], old_header['height']) == (new_header['width'], new_header['height'])
+    }
+    if not report['same_size']:
+        return report
+
+    width, height = new_header['width'], new_header['height']
+    keys = (np.arange(256), np.arange(256)) if by_index else (old_palette, new_palette)
+    starts, ends = changed_segments(read_runs(old_data, width * height), read_runs(new_data, width * height), *keys)
+    left, right = row_extents(starts, ends, width, height)
+
+    report['changed_stitches'] = int((ends - starts).sum())
+    report['changed_rows'] = row_ranges(np.flatnonzero(right >= 0).tolist())
+    report['bounding_boxes'] = bounding_boxes(left, right)
+    report['segments'] = (starts, ends) # for the overlay, dropped before the report is printed
+    return report
+
+
+def diff_files(old_path: str, new_path: str, by_index: bool = False) -> dict:
+    """
+    Compare two .dat files, both are memory mapped so only the header, palette and run lengths are ever read.
+
+    :return: The report from diff_bytes with the two paths added.
+    """
+    with open(old_path, 'rb') as old_file, open(new_path, 'rb') as new_file, \
+            mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ) as old_data, \
+            mmap.mmap(new_file.fileno(), 0, access=mmap.ACCESS_READ) as new_data:
+        report = diff_bytes(old_data, new_data, by_index)
+    return {'old': old_path, 'new': new_path, **report}
+
+
+def save_overlay(report: dict, new_path: str, output_path: str) -> None:
+    """
+    Save the new design cropped to the area around all the changes, with changed stitches in full color and everything else faded out.
+    This is the only part of the diff that decodes a raster, and only the rows the changes are in are decoded.
+
+    :param report: A report from diff_files with changes in it.
+    :param new_path: The new .dat file.
+    :param output_path: Where to write the PNG.
+    """
+    boxes = report['bounding_boxes']
+    x0 = min(box['x'] for box in boxes)
+    x1 = max(box['x'] + box['width'] for box in boxes)
+    y0 = min(box['y'] for box in boxes)
+    y1 = max(box['y'] + box['height'] for box in boxes)
+
+    with DatReader(new_path) as reader:
+        width = reader.width
+        indices = np.frombuffer(reader.read_rows(y0, y1 - y0), dtype=np.uint8).reshape(y1 - y0, width)[:, x0:x1]
+        palette = np.frombuffer(bytes(reader.rgb_palette()), dtype=np.uint8).reshape(256, 3)
+
+    # every changed stitch is inside the box rows, so the segments are shifted to start at the box's bottom row
+    # and the changed stitches are marked by toggling a flag at each segment boundary and running a cumulative xor over it
+    starts, ends = report['segments']
+    toggles = np.zeros((y1 - y0) * width + 1, dtype=np.uint8)
+    np.bitwise_xor.at(toggles, starts - y0 * width, 1)
+    np.bitwise_xor.at(toggles, ends - y0 * width, 1)
+    changed = np.bitwise_xor.accumulate(toggles[:-1]).view(bool).reshape(y1 - y0, width)[:, x0:x1]
+
+    # entries 0-255 are the palette, 256-511 the faded palette, so each stitch is a single lookup
+    faded = (palette * OVERLAY_FADE + 255 * (1 - OVERLAY_FADE)).astype(np.uint8)
+    table = np.concatenate((palette, faded))
+    overlay = table[indices + (~changed * np.uint16(256))]
+    # rows are bottom first, flip so the image is the right way up like the viewer's
+    Image.fromarray(np.ascontiguousarray(overlay[::-1])).save(output_path)
+
+
+def print_report(report: dict) -> None:
+    print(f"--- {report['old']}")
+    print(f"+++ {report['new']}")
+    for name, (old, new) in report['header_changes'].items():
+        print(f"header {name}: {old} -> {new}")
+    for change in report['palette_changes']:
+        print(f"palette {change['index']}: {change['old']} -> {change['new']}")
+    if not report['same_size']:
+        print("canvas sizes differ, stitches not compared")
+        return
+
+    print(f"{report['changed_stitches']} stitches changed")
+    if report['changed_rows']:
+        print("rows: " + ', '.join(str(first) if first == last else f'{first}-{last}' for first, last in report['changed_rows']))
+    for box in report['bounding_boxes']:
+        print(f"box: x {box['x']}, y {box['y']}, {box['width']}x{box['height']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="show which stitches, palette entries and header values changed between two .dat files")
+    parser.add_argument("old", help="the original .dat file")
+    parser.add_argument("new", help="the revised .dat file")
+    parser.add_argument("-i", "--by-index", action="store_true", help="compare color indices instead of the colors they show")
+    parser.add_argument("-j", "--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("-o", "--overlay", help="write a PNG of the changed area with the changed stitches highlighted")
+    args = parser.parse_args()
+
+    report = diff_files(args.old, args.new, args.by_index)
+    if args.overlay and report.get('bounding_boxes'):
+        save_overlay(report, args.new, args.overlay)
+    report.pop('segments', None)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    # like diff, exit status 1 means the files differ
+    differs = report['header_changes'] or report['palette_changes'] or not report['same_size'] or report['changed_stitches']
+    sys.exit(1 if differs else 0)
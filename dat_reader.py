@@ -0,0 +1,262 @@
+"""
+Lazy, random access reading of very large .dat files
+the file is memory mapped, the header and palette are read right away, and raster rows are only decoded when they are asked for
+"""
+import hashlib
+import mmap
+import os
+import struct
+
+import numpy as np
+
+import profiling
+from dat_codec import DatImage, RASTER_OFFSET, interleave_palette, read_header, read_palette
+from png_writer import IndexedPngWriter
+
+# how many RLE pairs to look at at once while building the row index, keeps the scan's memory use bounded
+SCAN_CHUNK_PAIRS = 1 << 20
+
+# row index sidecar (e.g. design.dat.idx): a fixed header then the row offsets and row skips as little endian int64 arrays
+# the header records the .dat file's size, mtime and a hash of its header + palette so a stale index is never used
+SIDECAR_SUFFIX = '.idx'
+SIDECAR_MAGIC = b'DATIDX01'
+SIDECAR_HEADER = struct.Struct('<8sQqIII20s') # magic, file size, mtime (ns), index step, width, height, sha1 of 0x000-0x5FF
+
+
+class DatReader:
+    """
+    Memory mapped .dat reader that decodes only the rows or regions that are requested.
+
+    The RLE data has no row markers, so the first time any row is requested the run lengths are scanned once to build a sparse index
+    holding, for every index_step-th row, the byte offset of the RLE pair that row starts in and how many pixels of that run belong to earlier rows.
+    Reading a row then only walks the runs between the nearest indexed row and the rows being read.
+    Rows are numbered like the raster data, so row 0 is the bottom row of the canvas.
+    """
+
+    def __init__(self, file_path: str, index_step: int = 16, use_sidecar: bool = False):
+        self.file_path = file_path
+        self.index_step = index_step
+        self.use_sidecar = use_sidecar
+        self.sidecar_path = file_path + SIDECAR_SUFFIX
+        self._file = open(file_path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = read_header(self._data)
+        self.min_x = header['min_x']
+        self.min_y = header['min_y']
+        self.width = header['width']
+        self.height = header['height']
+        self.magic_a = header['magic_a']
+        self.magic_b = header['magic_b']
+        self.palette_r, self.palette_g, self.palette_b = read_palette(self._data)
+
+        # filled in on the first row read: byte offset and intra-run position of every index_step-th row
+        self.row_offsets = None
+        self.row_skips = None
+
+    def close(self) -> None:
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def build_row_index(self) -> None:
+        """
+        Scan the run lengths once (without expanding them) and record where every index_step-th row starts.
+        Rows that start past the end of the RLE data get the end of the file as their offset, so they read back as color index 0.
+        """
+        row_starts = np.arange(0, self.height, self.index_step, dtype=np.int64) * self.width
+        self.row_offsets = np.full(len(row_starts), len(self._data), dtype=np.int64)
+        self.row_skips = np.zeros(len(row_starts), dtype=np.int64)
+
+        pair_count = max(len(self._data) - RASTER_OFFSET, 0) // 2
+        pixels_before = 0 # pixels covered by the runs before the current chunk
+        next_row = 0
+        for first_pair in range(0, pair_count, SCAN_CHUNK_PAIRS):
+            if next_row >= len(row_starts):
+                break
+            chunk_pairs = min(SCAN_CHUNK_PAIRS, pair_count - first_pair)
+            repeat_counts = np.frombuffer(self._data, dtype=np.uint8, count=2 * chunk_pairs, offset=RASTER_OFFSET + 2 * first_pair)[1::2]
+            run_ends = pixels_before + np.cumsum(repeat_counts, dtype=np.int64)
+
+            # every indexed row that starts inside this chunk lands in the first run that ends after it
+            last_row = np.searchsorted(row_starts, run_ends[-1], side='left')
+            targets = row_starts[next_row:last_row]
+            runs = np.searchsorted(run_ends, targets, side='right')
+            self.row_offsets[next_row:last_row] = RASTER_OFFSET + 2 * (first_pair + runs)
+            self.row_skips[next_row:last_row] = targets - (run_ends[runs] - repeat_counts[runs])
+
+            next_row = last_row
+            pixels_before = int(run_ends[-1])
+
+    def load_or_build_row_index(self) -> None:
+        """
+        Build the row index, going through the sidecar file if use_sidecar is set: a valid sidecar is loaded instead of scanning,
+        otherwise the index is built and written out so the next open of the same file can skip the scan.
+        """
+        if not self.use_sidecar:
+            self.build_row_index()
+        elif not self.load_sidecar():
+            self.build_row_index()
+            self.save_sidecar()
+
+    def sidecar_header(self) -> bytes:
+        """
+        :return: The sidecar header describing this file as it is on disk right now.
+        """
+        stat = os.stat(self._file.fileno())
+        digest = hashlib.sha1(self._data[:RASTER_OFFSET]).digest()
+        return SIDECAR_HEADER.pack(SIDECAR_MAGIC, stat.st_size, stat.st_mtime_ns, self.index_step, self.width, self.height, digest)
+
+    def load_sidecar(self) -> bool:
+        """
+        Load the row index from the sidecar file.
+
+        :return: True if the sidecar exists and matches this file (size, mtime, header/palette hash, index step), False otherwise.
+        """
+        try:
+            with open(self.sidecar_path, 'rb') as file:
+                contents = file.read()
+        except OSError:
+            return False
+
+        if contents[:SIDECAR_HEADER.size] != self.sidecar_header():
+            return False
+
+        # a truncated sidecar (e.g. an interrupted write) is treated as stale, it's just rebuilt
+        row_count = (self.height + self.index_step - 1) // self.index_step
+        if len(contents) - SIDECAR_HEADER.size != 2 * 8 * row_count:
+            return False
+        arrays = np.frombuffer(contents, dtype='<i8', offset=SIDECAR_HEADER.size)
+
+        self.row_offsets = arrays[:row_count].astype(np.int64)
+        self.row_skips = arrays[row_count:].astype(np.int64)
+        return True
+
+    def save_sidecar(self) -> None:
+        """
+        Write the row index out to the sidecar file, a sidecar that can't be written (e.g. read only directory) is just skipped.
+        """
+        # written to a temporary name and moved into place, so other readers never see half a sidecar
+        temp_path = f'{self.sidecar_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(self.sidecar_header())
+                file.write(self.row_offsets.astype('<i8').tobytes())
+                file.write(self.row_skips.astype('<i8').tobytes())
+            os.replace(temp_path, self.sidecar_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def read_rows(self, start_row: int, row_count: int = 1) -> bytearray:
+        """
+        Decode a block of consecutive rows.
+
+        :param start_row: The first row to read, 0 is the bottom row.
+        :param row_count: How many rows to read.
+        :return: A bytearray of row_count * width color indices.
+        """
+        if start_row < 0 or row_count < 0 or start_row + row_count > self.height:
+            raise IndexError(f"Rows {start_row} to {start_row + row_count - 1} are outside the canvas (height {self.height}).")
+        if self.row_offsets is None:
+            self.load_or_build_row_index()
+
+        checkpoint = start_row // self.index_step
+        offset = int(self.row_offsets[checkpoint])
+        skip = int(self.row_skips[checkpoint]) + (start_row - checkpoint * self.index_step) * self.width
+
+        pixel_count = row_count * self.width
+        indices = bytearray(pixel_count) # anything past the end of the RLE data stays at color index 0
+        output = np.frombuffer(indices, dtype=np.uint8)
+        pos = -skip # pixels before 0 belong to rows between the checkpoint and start_row and are thrown away
+        while pos < pixel_count:
+            # every pair but a zero run covers at least one pixel, so this many pairs is enough unless there are zero runs (then it goes round again)
+            chunk_pairs = min(pixel_count - pos, SCAN_CHUNK_PAIRS, (len(self._data) - offset) // 2)
+            if chunk_pairs <= 0:
+                break
+            pairs = np.frombuffer(self._data, dtype=np.uint8, count=2 * chunk_pairs, offset=offset)
+            color_indices, repeat_counts = pairs[0::2], pairs[1::2]
+            run_ends = pos + np.cumsum(repeat_counts, dtype=np.int64)
+
+            # runs past the one that fills the rows are dropped and that one is cut to fit
+            last = int(np.searchsorted(run_ends, pixel_count, side='left'))
+            if last < chunk_pairs:
+                color_indices = color_indices[:last + 1]
+                repeat_counts = repeat_counts[:last + 1].copy()
+                repeat_counts[-1] -= run_ends[last] - pixel_count
+            pixels = np.repeat(color_indices, repeat_counts)
+            if pos + len(pixels) > 0:
+                output[max(pos, 0):pos + len(pixels)] = pixels[max(-pos, 0):]
+            pos += len(pixels)
+            offset += 2 * len(color_indices)
+        return indices
+
+    def read_row(self, row: int) -> bytearray:
+        """
+        :param row: The row to read, 0 is the bottom row.
+        :return: A bytearray of width color indices.
+        """
+        return self.read_rows(row, 1)
+
+    def iter_rows_top_down(self):
+        """
+        Decode the rows from the top of the canvas down (the order images are stored in), index_step rows at a time,
+        so only one block of rows is ever in memory.
+
+        :return: A generator of bytearrays of width color indices, top row first.
+        """
+        for block_start in range((self.height - 1) // self.index_step * self.index_step, -1, -self.index_step):
+            block_rows = min(self.index_step, self.height - block_start)
+            rows = self.read_rows(block_start, block_rows)
+            for row in range(block_rows - 1, -1, -1):
+                yield rows[row * self.width:(row + 1) * self.width]
+
+    def rgb_palette(self) -> bytearray:
+        """
+        :return: The palette as 768 interleaved r, g, b bytes.
+        """
+        return interleave_palette(self.palette_r, self.palette_g, self.palette_b)
+
+    def read_region(self, x: int, y: int, width: int, height: int) -> DatImage:
+        """
+        Decode a rectangle of the canvas.
+
+        :param x: Left edge of the region.
+        :param y: Bottom edge of the region (row 0 is the bottom row).
+        :param width: Width of the region.
+        :param height: Height of the region.
+        :return: A DatImage of just that region, with this file's palette.
+        """
+        if x < 0 or width < 0 or x + width > self.width:
+            raise IndexError(f"Columns {x} to {x + width - 1} are outside the canvas (width {self.width}).")
+
+        rows = self.read_rows(y, height)
+        indices = bytearray().join(rows[row * self.width + x:row * self.width + x + width] for row in range(height))
+        return DatImage(width, height, self.palette_r, self.palette_g, self.palette_b, indices)
+
+
+def stream_to_png(file_path: str, output_path: str) -> tuple:
+    """
+    Decode a .dat file straight into a palette PNG a block of rows at a time, so memory stays at a few rows however tall the design is.
+    The raster goes bottom-up, so rows are read back from the top to give the same flip as DatImage.to_image.
+
+    :param file_path: The .dat file.
+    :param output_path: Where to write the PNG.
+    :return: (width, height) of the design.
+    """
+    with DatReader(file_path) as reader, open(output_path, 'wb') as output_file, \
+            profiling.stage('stream rows', rows=reader.height, pixels=reader.width * reader.height) as stage:
+        writer = IndexedPngWriter(output_file, reader.width, reader.height, reader.rgb_palette())
+        for row in reader.iter_rows_top_down():
+            writer.write_row(row)
+        writer.close()
+        stage['bytes_read'] = os.path.getsize(file_path)
+        stage['bytes_written'] = output_file.tell()
+    return reader.width, reader.height
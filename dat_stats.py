@@ -0,0 +1,124 @@
+"""
+Color and stitch statistics for .dat files, worked out from the RLE pairs without expanding the raster
+stitches per color are the repeat counts summed per color index, and per row figures come from cutting the runs at the row boundaries,
+so everything scales with the number of runs plus the number of rows rather than the number of stitches
+rows are numbered like the raster data, row 0 is the bottom row of the canvas (the first course knitted)
+"""
+import argparse
+import csv
+import json
+import mmap
+
+import numpy as np
+
+from batch_convert import collect_inputs
+from dat_codec import PALETTE_SIZE, read_header, read_palette, read_runs, row_segments
+
+
+def stats_bytes(data) -> dict:
+    """
+    Work out the stitch statistics of a .dat file's contents.
+
+    :param data: The whole file (bytes or an mmap).
+    :return: A dict with the canvas size, stitches per color (only colors that are used), and per row stitches per color
+             and color changes (places where a stitch is a different color from the one before it in the same row).
+    """
+    header = read_header(data)
+    width, height = header['width'], header['height']
+    if width <= 0 or height <= 0:
+        raise ValueError(f"header bounds are empty or reversed: width {width}, height {height}")
+    hex_colors = ["#{:02x}{:02x}{:02x}".format(*color) for color in zip(*read_palette(data))]
+
+    run_ends, run_colors = read_runs(data, width * height)
+    rows, colors, lengths = row_segments(run_ends, run_colors, width, height)
+
+    # stitches per color: one weighted bincount over the pieces
+    color_stitches = np.bincount(colors, weights=lengths, minlength=PALETTE_SIZE).astype(np.int64)
+
+    # stitches per (row, color): each pair gets a single key, so one more bincount over the keys that actually occur does it
+    keys, inverse = np.unique(rows * PALETTE_SIZE + colors, return_inverse=True)
+    key_stitches = np.bincount(inverse.ravel(), weights=lengths).astype(np.int64)
+    key_rows, key_colors = keys // PALETTE_SIZE, keys % PALETTE_SIZE
+
+    # a color change is a piece that isn't the first in its row and has a different color to the piece before it
+    changes = (rows[1:] == rows[:-1]) & (colors[1:] != colors[:-1])
+    row_changes = np.bincount(rows[1:][changes], minlength=height)
+
+    row_colors = [{} for _ in range(height)]
+    for row, color, stitches in zip(key_rows.tolist(), key_colors.tolist(), key_stitches.tolist()):
+        row_colors[row][color] = stitches
+
+    return {
+        'width': width,
+        'height': height,
+        'stitches': width * height,
+        'colors': [{'index': int(index), 'color': hex_colors[index], 'stitches': int(color_stitches[index])}
+                   for index in np.flatnonzero(color_stitches)],
+        'color_changes': int(row_changes.sum()),
+        'rows': [{'row': row, 'colors': row_colors[row], 'color_changes': int(row_changes[row])} for row in range(height)]
+    }
+
+
+def stats_file(file_path: str) -> dict:
+    """
+    Work out the stitch statistics of a .dat file, the file is memory mapped so only the header, palette and runs are read.
+
+    :return: The stats from stats_bytes with the path added.
+    """
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return {'path': file_path, **stats_bytes(data)}
+
+
+def write_colors_csv(all_stats: list, output_path: str) -> None:
+    """Write one CSV line per color per file: path, color index, color, stitches."""
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['path', 'color_index', 'color', 'stitches'])
+        for stats in all_stats:
+            for color in stats['colors']:
+                writer.writerow([stats['path'], color['index'], color['color'], color['stitches']])
+
+
+def write_rows_csv(all_stats: list, output_path: str) -> None:
+    """Write one CSV line per color per row per file: path, row, color index, stitches, and the row's color changes."""
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['path', 'row', 'color_index', 'stitches', 'row_color_changes'])
+        for stats in all_stats:
+            for row in stats['rows']:
+                for color_index, stitches in row['colors'].items():
+                    writer.writerow([stats['path'], row['row'], color_index, stitches, row['color_changes']])
+
+
+def print_stats(stats: dict) -> None:
+    print(f"{stats['path']}: {stats['width']}x{stats['height']}, {stats['stitches']} stitches, {stats['color_changes']} color changes")
+    for color in stats['colors']:
+        print(f"    {color['index']:>3} {color['color']} {color['stitches']:>10} ({100 * color['stitches'] / stats['stitches']:.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="count stitches per color, per row and color changes per row in .dat files")
+    parser.add_argument("inputs", nargs="+", help=".dat files, directories or glob patterns")
+    parser.add_argument("-r", "--recursive", action="store_true", help="look in subdirectories too")
+    parser.add_argument("-j", "--json", help="write the full stats (including per row figures) to this JSON file")
+    parser.add_argument("-c", "--colors-csv", help="write stitches per color to this CSV file")
+    parser.add_argument("--rows-csv", help="write stitches per color per row to this CSV file")
+    args = parser.parse_args()
+
+    all_stats = []
+    for path in collect_inputs(args.inputs, args.recursive):
+        if path.lower().endswith('.dat'):
+            try:
+                all_stats.append(stats_file(path))
+            except (OSError, ValueError) as e:
+                print(f"FAILED {path}: {e}")
+                continue
+            print_stats(all_stats[-1])
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(all_stats, file, indent=2)
+    if args.colors_csv:
+        write_colors_csv(all_stats, args.colors_csv)
+    if args.rows_csv:
+        write_rows_csv(all_stats, args.rows_csv)
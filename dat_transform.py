@@ -0,0 +1,248 @@
+"""
+Crop, tile, mirror and paste .dat designs without expanding them into stitches
+each row is kept as a list of runs (color index + length, any length), so every operation works on runs: touching runs of the same color
+are merged back together and long runs are only split at 255 again when the file is written
+rows are numbered like the raster data, row 0 is the bottom row of the canvas, and x goes left to right
+"""
+import argparse
+
+import numpy as np
+
+from dat_codec import DatImage, MAGIC_NUMBER, MAX_COORDINATE, build_header, encode_runs, read_header, read_palette, read_runs, row_segments
+
+EMPTY_ROW = (np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64))
+
+
+def merge_runs(colors: np.ndarray, lengths: np.ndarray) -> tuple:
+    """
+    :return: (colors, lengths) with zero length runs dropped and touching runs of the same color joined into one.
+    """
+    keep = lengths > 0
+    colors, lengths = colors[keep], lengths[keep]
+    if not len(colors):
+        return EMPTY_ROW
+    starts = np.flatnonzero(np.concatenate(([True], colors[1:] != colors[:-1])))
+    return colors[starts], np.add.reduceat(lengths, starts)
+
+
+def cut_row(row: tuple, start: int, end: int) -> tuple:
+    """
+    :param row: (colors, lengths) of one row.
+    :return: The runs covering stitches start up to (not including) end of the row, with the first and last run trimmed to fit.
+    """
+    if end <= start:
+        return EMPTY_ROW
+    colors, lengths = row
+    run_ends = np.cumsum(lengths)
+    first = np.searchsorted(run_ends, start, side='right')
+    last = np.searchsorted(run_ends, end, side='left')
+    trimmed = lengths[first:last + 1].copy()
+    trimmed[-1] -= run_ends[last] - end
+    trimmed[0] -= start - (run_ends[first] - lengths[first])
+    return colors[first:last + 1], trimmed
+
+
+def join_rows(*rows) -> tuple:
+    """:return: The rows placed one after another as a single row."""
+    return merge_runs(np.concatenate([row[0] for row in rows]), np.concatenate([row[1] for row in rows]))
+
+
+class RunImage:
+    """
+    A .dat design held as runs per row rather than stitches, so cropping, tiling, mirroring and pasting cost time in proportion to the
+    number of runs. Operations return a new RunImage and never change the rows they were given.
+    """
+
+    def __init__(self, width: int, height: int, palette_r, palette_g, palette_b, rows: list, min_x: int = 0, min_y: int = 0):
+        """
+        :param palette_r: The palette in color index order, 256 red values (same as DatImage).
+        :param palette_g: 256 green values.
+        :param palette_b: 256 blue values.
+        :param rows: height (colors, lengths) pairs, bottom row first, each row's lengths adding up to width.
+        """
+        self.width = width
+        self.height = height
+        self.palette_r = bytearray(palette_r)
+        self.palette_g = bytearray(palette_g)
+        self.palette_b = bytearray(palette_b)
+        self.rows = rows
+        self.min_x = min_x
+        self.min_y = min_y
+        self.magic_a = MAGIC_NUMBER
+        self.magic_b = MAGIC_NUMBER
+
+    @classmethod
+    def load(cls, file_path: str) -> 'RunImage':
+        with open(file_path, 'rb') as file:
+            return cls.from_bytes(file.read())
+
+    @classmethod
+    def from_bytes(cls, data) -> 'RunImage':
+        """
+        Read the runs of a .dat file's contents and cut them at the row boundaries, without expanding them.
+
+        :param data: The whole file as bytes.
+        :return: The RunImage.
+        """
+        header = read_header(data)
+        width, height = header['width'], header['height']
+        if width <= 0 or height <= 0:
+            raise ValueError(f"header bounds are empty or reversed: width {width}, height {height}")
+
+        rows, colors, lengths = row_segments(*read_runs(data, width * height), width, height)
+        # merge touching runs of the same color in the same row (e.g. a long run split at 255), then hand each row its slice
+        starts = np.flatnonzero(np.concatenate(([True], (rows[1:] != rows[:-1]) | (colors[1:] != colors[:-1]))))
+        rows, colors, lengths = rows[starts], colors[starts], np.add.reduceat(lengths, starts)
+        bounds = np.searchsorted(rows, np.arange(height + 1))
+        row_runs = [(colors[bounds[row]:bounds[row + 1]], lengths[bounds[row]:bounds[row + 1]]) for row in range(height)]
+        image = cls(width, height, *read_palette(data), row_runs, header['min_x'], header['min_y'])
+        image.magic_a = header['magic_a']
+        image.magic_b = header['magic_b']
+        return image
+
+    def to_bytes(self) -> bytearray:
+        """
+        :return: The full .dat file contents, long runs split at 255.
+        """
+        header = build_header(self.width, self.height, self.palette_r, self.palette_g, self.palette_b,
+                              self.min_x, self.min_y, self.magic_a, self.magic_b)
+        return header + encode_runs(np.concatenate([row[0] for row in self.rows]), np.concatenate([row[1] for row in self.rows]))
+
+    def save(self, file_path: str) -> None:
+        with open(file_path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    def with_rows(self, width: int, rows: list) -> 'RunImage':
+        """:return: A RunImage with the same palette and header values and the given rows."""
+        image = RunImage(width, len(rows), self.palette_r, self.palette_g, self.palette_b, rows, self.min_x, self.min_y)
+        image.magic_a = self.magic_a
+        image.magic_b = self.magic_b
+        return image
+
+    def crop(self, x: int, y: int, width: int, height: int) -> 'RunImage':
+        """
+        :param x: Left edge of the rectangle to keep.
+        :param y: Bottom row of the rectangle to keep.
+        :return: Just the rectangle, clipped to the canvas.
+        """
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError(f"crop rectangle {width}x{height} at ({x}, {y}) is outside the {self.width}x{self.height} canvas")
+        return self.with_rows(x1 - x0, [cut_row(row, x0, x1) for row in self.rows[y0:y1]])
+
+    def tile(self, columns: int, rows: int) -> 'RunImage':
+        """
+        :return: The design repeated columns times across and rows times up.
+        """
+        if columns < 1 or rows < 1:
+            raise ValueError(f"Can't tile {columns} across and {rows} up.")
+        width, height = self.width * columns, self.height * rows
+        if self.min_x + width - 1 > MAX_COORDINATE or self.min_y + height - 1 > MAX_COORDINATE:
+            raise ValueError(f"Tiling {columns} across and {rows} up makes a {width}x{height} design, "
+                             f"the header can't hold bounds past {MAX_COORDINATE} (min x {self.min_x}, min y {self.min_y}).")
+        tiled_rows = [merge_runs(np.tile(colors, columns), np.tile(lengths, columns)) for colors, lengths in self.rows]
+        return self.with_rows(width, tiled_rows * rows)
+
+    def mirror(self, horizontal: bool = True) -> 'RunImage':
+        """
+        :param horizontal: True to flip left to right, False to flip top to bottom.
+        :return: The mirrored design.
+        """
+        if horizontal:
+            return self.with_rows(self.width, [(colors[::-1], lengths[::-1]) for colors, lengths in self.rows])
+        return self.with_rows(self.width, self.rows[::-1])
+
+    def add_palette_colors(self, other: 'RunImage') -> np.ndarray:
+        """
+        Add the colors other uses to this palette: colors this design already uses keep their existing index (lowest wins),
+        the rest are written into palette entries this design doesn't use.
+
+        :return: 256 entry table from other's color indices to this design's.
+        """
+        palette = list(zip(self.palette_r, self.palette_g, self.palette_b))
+        used = set(np.concatenate([colors for colors, _ in self.rows]).tolist())
+        # only entries this design actually uses count as having a color, an unused entry can be handed out below and overwritten
+        lookup = {}
+        for index in sorted(used, reverse=True):
+            lookup[palette[index]] = index
+        free_indices = [index for index in range(255, -1, -1) if index not in used]
+
+        other_palette = list(zip(other.palette_r, other.palette_g, other.palette_b))
+        translation = np.arange(256, dtype=np.uint8)
+        for index in sorted(set(np.concatenate([colors for colors, _ in other.rows]).tolist())):
+            color = other_palette[index]
+            if color not in lookup:
+                if not free_indices:
+                    raise ValueError("Not enough unused palette entries for the pasted design's colors.")
+                lookup[color] = free_indices.pop()
+                palette[lookup[color]] = color
+            translation[index] = lookup[color]
+
+        self.palette_r, self.palette_g, self.palette_b = (bytearray(channel) for channel in zip(*palette))
+        return translation
+
+    def paste(self, other: 'RunImage', x: int, y: int) -> 'RunImage':
+        """
+        Paste another design on top of this one, anything hanging off the canvas is cut off.
+        Colors the pasted design brings in are added to unused entries of this palette.
+
+        :param other: The design to paste.
+        :param x: Where the left edge of other goes.
+        :param y: Which row the bottom row of other goes on.
+        :return: The combined design.
+        """
+        result = self.with_rows(self.width, list(self.rows))
+        translation = result.add_palette_colors(other)
+
+        # the part of other that lands on the canvas, in other's own coordinates
+        left, right = max(-x, 0), min(other.width, self.width - x)
+        for other_row in range(max(-y, 0), min(other.height, self.height - y)):
+            if right <= left:
+                break
+            colors, lengths = cut_row(other.rows[other_row], left, right)
+            row = y + other_row
+            result.rows[row] = join_rows(cut_row(self.rows[row], 0, x + left),
+                                         (translation[colors], lengths),
+                                         cut_row(self.rows[row], x + right, self.width))
+        return result
+
+    def to_dat(self) -> DatImage:
+        """:return: The design expanded into a DatImage, e.g. for viewing."""
+        return DatImage.from_bytes(bytes(self.to_bytes()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="crop, tile, mirror or paste .dat designs without expanding them")
+    parser.add_argument("input", help="the .dat file to transform")
+    parser.add_argument("-o", "--output", required=True, help="where to write the transformed .dat file")
+    operations = parser.add_subparsers(dest="operation", required=True)
+
+    crop_parser = operations.add_parser("crop", help="keep a rectangle (y is counted from the bottom row)")
+    for name in ("x", "y", "width", "height"):
+        crop_parser.add_argument(name, type=int)
+
+    tile_parser = operations.add_parser("tile", help="repeat the design across and up")
+    tile_parser.add_argument("columns", type=int)
+    tile_parser.add_argument("rows", type=int)
+
+    mirror_parser = operations.add_parser("mirror", help="flip the design")
+    mirror_parser.add_argument("direction", choices=["horizontal", "vertical"])
+
+    paste_parser = operations.add_parser("paste", help="paste another .dat on top (y is counted from the bottom row)")
+    paste_parser.add_argument("other", help="the .dat file to paste")
+    paste_parser.add_argument("x", type=int)
+    paste_parser.add_argument("y", type=int)
+    args = parser.parse_args()
+
+    image = RunImage.load(args.input)
+    if args.operation == "crop":
+        image = image.crop(args.x, args.y, args.width, args.height)
+    elif args.operation == "tile":
+        image = image.tile(args.columns, args.rows)
+    elif args.operation == "mirror":
+        image = image.mirror(args.direction == "horizontal")
+    else:
+        image = image.paste(RunImage.load(args.other), args.x, args.y)
+    image.save(args.output)
+    print(f"{image.width}x{image.height}, {sum(len(colors) for colors, _ in image.rows)} runs written to {args.output}")
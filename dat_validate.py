@@ -0,0 +1,206 @@
+"""
+Check .dat files for structural problems without decoding them
+the header, magic numbers and palette are checked, then the RLE pairs are scanned once in fixed size chunks (never expanded into an image)
+to make sure the runs cover exactly width * height stitches, so bad files can be caught before anything tries to render them
+"""
+import argparse
+import json
+import mmap
+import os
+import sys
+
+import numpy as np
+
+from batch_convert import collect_inputs
+from dat_codec import MAGIC_NUMBER, PALETTE_SIZE, RASTER_OFFSET, MAGIC_B_OFFSET, read_header, read_palette
+
+# how many RLE pairs to look at at once, keeps memory use bounded however big the file is
+SCAN_CHUNK_PAIRS = 1 << 20
+
+# the header shorts end at 0x012, anything shorter can't even be read
+HEADER_SIZE = MAGIC_B_OFFSET + 2
+
+
+def defined_palette_size(palette_r, palette_g, palette_b) -> int:
+    """
+    Files written with a short palette leave the rest of the chunks zeroed, so a guess at how many colors it was written with is where
+    the last non black entry is. Every file stores all 256 entries though, so this is only a guess: a black color at the end of a
+    compacted palette looks exactly like an unused entry.
+
+    :return: Number of palette entries up to and including the last one that isn't (0, 0, 0), at least 1 since index 0 is always usable.
+    """
+    defined = np.flatnonzero(np.frombuffer(bytes(palette_r), dtype=np.uint8)
+                             | np.frombuffer(bytes(palette_g), dtype=np.uint8)
+                             | np.frombuffer(bytes(palette_b), dtype=np.uint8))
+    return int(defined[-1]) + 1 if len(defined) else 1
+
+
+def scan_raster(data, pixel_count: int) -> dict:
+    """
+    Walk the RLE pairs once, a chunk at a time, without expanding them.
+
+    :param data: The whole file (bytes or an mmap).
+    :param pixel_count: width * height from the header.
+    :return: A dict with run_count (pairs up to the one that fills the canvas), covered_pixels (stitches those runs cover),
+             zero_runs (pairs with a repeat count of 0), used (256 bools, which color indices are drawn),
+             trailing_bytes (bytes after the pair that fills the canvas, including an odd byte at the end).
+    """
+    raster_size = max(len(data) - RASTER_OFFSET, 0)
+    pair_count = raster_size // 2
+    used = np.zeros(PALETTE_SIZE, dtype=bool)
+    covered_pixels = 0
+    zero_runs = 0
+    run_count = pair_count
+
+    for first_pair in range(0, pair_count, SCAN_CHUNK_PAIRS):
+        chunk_pairs = min(SCAN_CHUNK_PAIRS, pair_count - first_pair)
+        pairs = np.frombuffer(data, dtype=np.uint8, count=2 * chunk_pairs, offset=RASTER_OFFSET + 2 * first_pair)
+        color_indices, repeat_counts = pairs[0::2], pairs[1::2]
+        run_ends = covered_pixels + np.cumsum(repeat_counts, dtype=np.int64)
+
+        # only the runs up to the one that reaches the end of the canvas count, anything after them is trailing data
+        last = int(np.searchsorted(run_ends, pixel_count, side='left'))
+        filled = last < chunk_pairs
+        if filled:
+            chunk_pairs = last + 1
+            color_indices, repeat_counts = color_indices[:chunk_pairs], repeat_counts[:chunk_pairs]
+
+        drawn = repeat_counts != 0
+        zero_runs += chunk_pairs - int(np.count_nonzero(drawn))
+        used[color_indices[drawn]] = True
+        covered_pixels = int(run_ends[chunk_pairs - 1])
+
+        if filled:
+            run_count = first_pair + chunk_pairs
+            break
+
+    return {
+        'run_count': run_count,
+        'covered_pixels': covered_pixels,
+        'zero_runs': zero_runs,
+        'used': used,
+        'trailing_bytes': raster_size - 2 * run_count
+    }
+
+
+def validate_bytes(data) -> dict:
+    """
+    Check the structure of a .dat file's contents.
+
+    :param data: The whole file (bytes or an mmap).
+    :return: A report dict, 'valid' is False if there are any errors, warnings are for things the viewer copes with but probably shouldn't be there,
+             notes are things worth knowing that can be perfectly fine. 'readable' is True when the header, magic numbers and palette are fine,
+             so the file can be decoded even if its runs don't cover the canvas exactly (the decoders cut off or fill in with color index 0).
+    """
+    report = {'valid': False, 'readable': False, 'errors': [], 'warnings': [], 'notes': [], 'file_size': len(data)}
+    errors = report['errors']
+    warnings = report['warnings']
+    notes = report['notes']
+
+    if len(data) < HEADER_SIZE:
+        errors.append(f"file is {len(data)} bytes, too short for the header (0x{HEADER_SIZE:03x} bytes)")
+        return report
+
+    header = read_header(data)
+    report.update(header)
+    bounds_ok = header['width'] > 0 and header['height'] > 0
+    if not bounds_ok:
+        errors.append(f"header bounds are empty or reversed: width {header['width']}, height {header['height']}")
+    for name in ('magic_a', 'magic_b'):
+        if header[name] != MAGIC_NUMBER:
+            errors.append(f"{name} is {header[name]}, expected {MAGIC_NUMBER}")
+
+    if len(data) < RASTER_OFFSET:
+        errors.append(f"file is {len(data)} bytes, too short for the palette (raster data should start at 0x{RASTER_OFFSET:03x})")
+        return report
+    if not bounds_ok:
+        # without sensible bounds there's no pixel count to check the runs against
+        return report
+    report['readable'] = not errors
+
+    palette_size = defined_palette_size(*read_palette(data))
+    pixel_count = header['width'] * header['height']
+    scan = scan_raster(data, pixel_count)
+    used = np.flatnonzero(scan.pop('used'))
+    report.update(scan)
+    report['pixel_count'] = pixel_count
+    report['palette_size'] = palette_size
+    report['used_indices'] = used.tolist()
+    report['unused_palette_entries'] = palette_size - int(np.count_nonzero(used < palette_size))
+
+    if scan['covered_pixels'] < pixel_count:
+        errors.append(f"runs cover {scan['covered_pixels']} stitches, expected {pixel_count} ({header['width']}x{header['height']})")
+    elif scan['covered_pixels'] > pixel_count:
+        errors.append(f"last run overshoots the canvas by {scan['covered_pixels'] - pixel_count} stitches")
+
+    # the palette size is only a guess (see defined_palette_size), so indices past it are worth a note but not a warning
+    past_palette = used[used >= palette_size]
+    if len(past_palette):
+        notes.append(f"color indices {past_palette.tolist()} are black entries past the last non black color (index {palette_size - 1})")
+    if scan['zero_runs']:
+        warnings.append(f"{scan['zero_runs']} runs have a repeat count of 0")
+    if scan['trailing_bytes']:
+        warnings.append(f"{scan['trailing_bytes']} trailing bytes after the runs that fill the canvas")
+
+    report['valid'] = not errors
+    return report
+
+
+def validate_file(file_path: str) -> dict:
+    """
+    Check the structure of a .dat file, the file is memory mapped so nothing but the header is read up front.
+
+    :param file_path: Path to the .dat file.
+    :return: The report from validate_bytes with the path added, files that can't be opened get a report with one error.
+    """
+    try:
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                # mmap refuses empty files
+                report = validate_bytes(b'')
+            else:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    report = validate_bytes(data)
+    except OSError as e:
+        report = {'valid': False, 'readable': False, 'errors': [f"can't read file: {e.strerror}"], 'warnings': [], 'notes': []}
+    return {'path': file_path, **report}
+
+
+def print_report(report: dict) -> None:
+    print(f"{'OK  ' if report['valid'] else 'FAIL'} {report['path']}")
+    for error in report['errors']:
+        print(f"    error: {error}")
+    for warning in report['warnings']:
+        print(f"    warning: {warning}")
+    for note in report['notes']:
+        print(f"    note: {note}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check .dat files for structural problems without decoding them")
+    parser.add_argument("inputs", nargs="+", help=".dat files, directories or glob patterns to check")
+    parser.add_argument("-r", "--recursive", action="store_true", help="look in subdirectories too")
+    parser.add_argument("-j", "--json", action="store_true", help="print the reports as JSON instead of text")
+    parser.add_argument("-o", "--output", help="also write the JSON reports to this file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print files with errors or warnings")
+    args = parser.parse_args()
+
+    paths = [path for path in collect_inputs(args.inputs, args.recursive) if path.lower().endswith('.dat')]
+    reports = [validate_file(path) for path in paths]
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        for report in reports:
+            if not args.quiet or report['errors'] or report['warnings']:
+                print_report(report)
+        failed = sum(not report['valid'] for report in reports)
+        print(f"checked {len(reports)} files, {len(reports) - failed} valid, {failed} with errors")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(reports, file, indent=2)
+
+    # a non zero exit status lets ingestion scripts stop on bad files
+    sys.exit(1 if any(not report['valid'] for report in reports) else 0)
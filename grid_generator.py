@@ -1,58 +1,45 @@
 """Generate a grid (list of lists) of color indices from a .dat image or png"""
 
+import argparse
+import functools
+import hashlib
+import os
+
+import numpy as np
 from PIL import Image
 import colors
+import profiling
+from dat_codec import DatImage
+
+# nearest color lookup cube for quantizing off-palette colors, each channel is cut down to CUBE_BITS bits (64x64x64 cells)
+CUBE_BITS = 6
+CUBE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.palette_cache')
 
-def generate_dat_from_color_indices(color_indices: list, output_file_path: str) -> None:
+def generate_dat_from_color_indices(color_indices: list, output_file_path: str, compact: str = None, target_palette: list = None) -> None:
     """
     Generates and save a .dat file from a list of color indices where each index represents the index of that color in the r/g/b lists.
 
-    :param color_indices: A list of lists color indices in the format where each list corresponds to a row with the first being the bottom row of the dat canvas.
+    :param color_indices: A list of lists (or 2-D uint8 array) of color indices in the format where each list corresponds to a row with the first being the bottom row of the dat canvas.
     :param output_file_path: The path to the output file, ending in .dat.
+    :param compact: None to write the full colors.py palette, 'index' or 'frequency' to only write the colors that are used (see DatImage.compacted).
+    :param target_palette: With compact, a machine palette (list of (r, g, b)) to line the used colors up with.
     """
 
-    #0,0 is bottom left corner pixel of raster thus why decremented to start at 0 index
-    dat_width = len(color_indices[0]) - 1
+    # the last row of the grid is written out first since the .dat raster starts from the bottom row
+    with profiling.stage('build grid'):
+        grid = np.asarray(color_indices, dtype=np.uint8)[::-1]
+    dat_height, dat_width = grid.shape
     print(f'dat_width: {dat_width}')
-    dat_height = len(color_indices) - 1
     print(f'dat_height: {dat_height}')
 
-
-    with open(output_file_path, 'wb') as output_file:
-        # write header with width at 0x004, height at 0x006, and 1000 (magic #) at 0x008 and 0x010
-        output_file.seek(0x004)
-        output_file.write(dat_width.to_bytes(2, byteorder='little'))
-        output_file.seek(0x006)
-        output_file.write(dat_height.to_bytes(2, byteorder='little'))
-        output_file.seek(0x008)
-        output_file.write((1000).to_bytes(2, byteorder='little'))
-        output_file.seek(0x010)
-        output_file.write((1000).to_bytes(2, byteorder='little'))
-
-        # write color chunk
-        output_file.seek(0x200)
-        output_file.write(colors.red_color_bytes)
-        
-        output_file.seek(0x300)
-        output_file.write(colors.green_color_bytes)
-
-        output_file.seek(0x400)
-        output_file.write(colors.blue_color_bytes)
-
-        # write RLE encoded data (color index from rgb part of color chunk, then number of repeats)
-        output_file.seek(0x600)
-        repeats = 0
-
-        for y in range(dat_height, -1, -1):
-            row = color_indices[y]
-            for x in range(dat_width + 1):
-                repeats += 1
-                if x == dat_width or row[x] != row[x+1]: # if end of row or next color is different, write out
-                    output_file.write(row[x].to_bytes(1,byteorder='little'))
-                    output_file.write(repeats.to_bytes(1,byteorder='little'))
-                    repeats = 0
-    
-    output_file.close()
+    # the palette is the fixed color list from colors.py, header/palette/RLE writing is handled by the shared codec
+    dat = DatImage(dat_width, dat_height,
+                   colors.red_values, colors.green_values, colors.blue_values,
+                   grid.tobytes())
+    if compact:
+        with profiling.stage('palette compaction', pixels=grid.size):
+            dat = dat.compacted(compact, target_palette)
+    dat.save(output_file_path)
 
 
 def find_matching_color_index(pixel_rgb: list) -> int:
@@ -62,41 +49,173 @@ def find_matching_color_index(pixel_rgb: list) -> int:
     :param pixel_rgb: A list containing a red, green, and blue value
     :return: The index of the RGB value in the color list, or -1 if not found.
     """
+    return colors.color_index_lookup.get(tuple(pixel_rgb), -1)
+
+
+@functools.lru_cache(maxsize=None)
+def palette_key_table() -> tuple:
+    """
+    Packed 0xRRGGBB value of every color in the color list, sorted so a whole image can be matched with one searchsorted.
+    Built the first time it's needed rather than at import.
+
+    :return: (sorted uint32 keys, uint8 color index of each key).
+    """
+    keys, indices = zip(*sorted(((r << 16) | (g << 8) | b, index) for (r, g, b), index in colors.color_index_lookup.items()))
+    return np.array(keys, dtype=np.uint32), np.array(indices, dtype=np.uint8)
+
+
+def distinct_palette_indices(palette_rgb: np.ndarray) -> np.ndarray:
+    """
+    :param palette_rgb: A (256, 3) array of the palette colors in color index order.
+    :return: The lowest color index of every distinct color, in increasing order (so argmin ties go to the lowest index).
+    """
+    packed = (palette_rgb[:, 0].astype(np.uint32) << 16) | (palette_rgb[:, 1].astype(np.uint32) << 8) | palette_rgb[:, 2]
+    return np.sort(np.unique(packed, return_index=True)[1])
+
+
+def build_nearest_color_cube(palette_rgb: np.ndarray, bits: int = CUBE_BITS) -> np.ndarray:
+    """
+    Work out the nearest palette entry (squared RGB distance) to the center of every cell of a 3-D grid over RGB space, and whether
+    that entry is the nearest for every color in the cell: it is when the second nearest color is further from the center by more
+    than the cell's diagonal, since no color in the cell is more than half a diagonal from the center.
+
+    :param palette_rgb: A (256, 3) array of the palette colors in color index order.
+    :param bits: Bits kept per channel, the cube has (2 ** bits) ** 3 cells.
+    :return: A (2, 2 ** bits, 2 ** bits, 2 ** bits) uint8 array indexed by r, g, b shifted right by 8 - bits:
+             [0] is the color index nearest the cell's center, [1] is 1 where that's the nearest for the whole cell.
+    """
+    levels = 1 << bits
+    step = 256 >> bits
+    centers = np.arange(levels) * step + (step - 1) / 2
+    distinct = distinct_palette_indices(palette_rgb)
+    palette = palette_rgb[distinct].astype(np.float64)
+    palette_norms = (palette ** 2).sum(axis=1)
+    diagonal = np.sqrt(3) * (step - 1)
+
+    # |cell - color|^2 = |cell|^2 - 2 cell.color + |color|^2
+    # done one red slice at a time so the distance array stays at levels * levels * 256
+    green, blue = np.meshgrid(centers, centers, indexing='ij')
+    cube = np.empty((2, levels, levels * levels), dtype=np.uint8)
+    for red_level, red in enumerate(centers):
+        cells = np.stack([np.full(green.size, red), green.ravel(), blue.ravel()], axis=1)
+        distances = (cells ** 2).sum(axis=1)[:, None] - 2 * cells @ palette.T + palette_norms
+        nearest = distances.argmin(axis=1) # ties go to the lowest color index
+        two_nearest = np.sqrt(np.maximum(np.partition(distances, 1, axis=1)[:, :2], 0))
+        cube[0, red_level] = distinct[nearest]
+        cube[1, red_level] = two_nearest[:, 1] - two_nearest[:, 0] > diagonal
+    return cube.reshape(2, levels, levels, levels)
+
+
+@functools.lru_cache(maxsize=None)
+def nearest_color_cube() -> np.ndarray:
+    """
+    The nearest color cube for the colors.py palette, built once and kept in .palette_cache so later runs just load it.
+    The cache file is named after a hash of the palette, so a changed palette never picks up an old cube.
+
+    :return: The cube from build_nearest_color_cube.
+    """
+    digest = hashlib.sha1(colors.PALETTE_TABLE + bytes((CUBE_BITS,))).hexdigest()[:16]
+    cache_path = os.path.join(CUBE_CACHE_DIR, f'nearest_v2_{digest}.npy')
     try:
-        index = colors.color_list.index(pixel_rgb)
-        #print(f"Color: {pixel_rgb} -> Index: {index}")  # Debugging line
-        return index
-    except ValueError:
-        return -1
+        return np.load(cache_path)
+    except (OSError, ValueError):
+        pass
+
+    cube = build_nearest_color_cube(np.array(colors.color_list, dtype=np.uint8))
+    try:
+        # written to a temporary name and moved into place, so parallel conversions never load half a file
+        os.makedirs(CUBE_CACHE_DIR, exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            np.save(file, cube)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass # cache directory isn't writable, the cube just gets rebuilt next time
+    return cube
+
+
+def exact_nearest_color_indices(keys: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    """
+    :param keys: Packed 0xRRGGBB colors.
+    :return: The color index of the nearest palette entry to each color (squared RGB distance, ties to the lowest index),
+             checked against every palette color, chunk_size colors at a time.
+    """
+    palette_rgb = np.array(colors.color_list, dtype=np.uint8)
+    distinct = distinct_palette_indices(palette_rgb)
+    palette = palette_rgb[distinct].astype(np.int64)
+    palette_norms = (palette ** 2).sum(axis=1)
+    rgb = np.stack([keys >> 16, (keys >> 8) & 0xff, keys & 0xff], axis=1).astype(np.int64)
 
+    indices = np.empty(len(keys), dtype=np.uint8)
+    for start in range(0, len(keys), chunk_size):
+        # |color|^2 is the same for every palette entry so it's left out, integer maths keeps ties exact
+        distances = palette_norms - 2 * rgb[start:start + chunk_size] @ palette.T
+        indices[start:start + chunk_size] = distinct[distances.argmin(axis=1)]
+    return indices
 
-def find_matching_pixels(image_path: str) -> list:
+
+def nearest_color_indices(keys: np.ndarray) -> np.ndarray:
+    """
+    :param keys: Packed 0xRRGGBB colors.
+    :return: The color index of the nearest palette entry to each color (squared RGB distance, ties to the lowest index).
+             Most colors are answered by the nearest color cube, the ones in cells where two palette colors are close
+             to each other get an exact check against the whole palette.
+    """
+    shift = 8 - CUBE_BITS
+    mask = (1 << CUBE_BITS) - 1
+    cube = nearest_color_cube()
+    cells = (keys >> (16 + shift), (keys >> (8 + shift)) & mask, (keys & 0xff) >> shift)
+    indices = cube[0][cells]
+    unsure = cube[1][cells] == 0
+    if unsure.any():
+        indices[unsure] = exact_nearest_color_indices(keys[unsure])
+    return indices
+
+
+def find_matching_color_indices(rgb: np.ndarray, quantize: bool = False) -> np.ndarray:
+    """
+    Find the color list index of every pixel in an RGB array at once.
+
+    :param rgb: A (height, width, 3) uint8 array of RGB values.
+    :param quantize: Map colors that aren't in the color list to the nearest color that is, instead of raising ValueError.
+    :return: A (height, width) uint8 array of color indices.
+    """
+    with profiling.stage('palette mapping', pixels=rgb.shape[0] * rgb.shape[1]):
+        palette_keys, palette_key_indices = palette_key_table()
+        keys = (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+        positions = np.searchsorted(palette_keys, keys).clip(max=len(palette_keys) - 1)
+        indices = palette_key_indices[positions]
+
+        unmatched = palette_keys[positions] != keys
+        if unmatched.any():
+            if not quantize:
+                y, x = np.argwhere(unmatched)[0]
+                raise ValueError(f"Color {tuple(rgb[y, x].tolist())} not found in the valid color list.")
+            # exact colors keep their own index, every other distinct color is looked up once and spread back out to its pixels
+            with profiling.stage('quantize', pixels=int(unmatched.sum())) as stage:
+                unique_keys, inverse = np.unique(keys[unmatched], return_inverse=True)
+                indices[unmatched] = nearest_color_indices(unique_keys)[inverse]
+                stage['unique_colors'] = len(unique_keys)
+
+    return indices
+
+
+def find_matching_pixels(image_path: str, quantize: bool = False) -> np.ndarray:
     """
     Gets the indices in the color list of each pixel (e.g., ith element of red, green, and blue chunks of color info in .dat file).
 
     :param image_path: Path to the image.
-    :param rgb_values_set: A set of RGB values to search for.
-    :return: A list of pixel coordinates (x, y) that match the RGB values.
+    :param quantize: Map colors that aren't in the color list (anti-aliasing, JPEG artwork) to the nearest one instead of raising ValueError.
+    :return: A 2-D uint8 array of color indices, one row per image row going across.
     """
-    img = Image.open(image_path).convert('RGB')
-    width, height = img.size
+    with profiling.stage('png read', bytes_read=os.path.getsize(image_path)):
+        img = Image.open(image_path).convert('RGB')
+        width, height = img.size
     print(f'width: {width}, height: {height}')
-    matching_pixel_grid = []
-
-    # generate grid of color indices that match grid of image pixels
-    # each row is a list of pixel colors going across
-    for y in range(height):
-        row_color_indices = []
-        for x in range(width):
-            pixel_rgb = img.getpixel((x, y))[:3]
-            color_index = find_matching_color_index(pixel_rgb)
-            row_color_indices.append(color_index)
-
-            if color_index < 0:
-                raise ValueError(f"Color {pixel_rgb} not found in the valid color list.")
-        matching_pixel_grid.append(row_color_indices)
 
-    return matching_pixel_grid
+    # match the whole image in one pass over its raw bytes instead of looking up each pixel
+    rgb = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(height, width, 3)
+    return find_matching_color_indices(rgb, quantize)
 
 def generate_image_from_pixel_list(pixel_list: list, output_file_path: str) -> None:
     """
@@ -109,17 +228,26 @@ def generate_image_from_pixel_list(pixel_list: list, output_file_path: str) -> N
     width = len(pixel_list[0])
     height = len(pixel_list)
 
-    img = Image.new('RGB', (width, height))
-    for y in range(height):
-        for x in range(width): # x is the index of the pixel in the row, not the color index
-            color_index = pixel_list[y][x]
-            img.putpixel((x, y), colors.color_list[color_index])
+    with profiling.stage('pixel writes', pixels=width * height):
+        img = Image.new('RGB', (width, height))
+        for y in range(height):
+            for x in range(width): # x is the index of the pixel in the row, not the color index
+                color_index = pixel_list[y][x]
+                img.putpixel((x, y), colors.color_list[color_index])
 
-    img.save(output_file_path)
+    with profiling.stage('png write') as stage:
+        img.save(output_file_path)
+        stage['bytes_written'] = os.path.getsize(output_file_path)
 
 
 if __name__ == "__main__":
-    image_path = "stst_10.dat.png"
-    matching_pixels = find_matching_pixels(image_path)
+    parser = argparse.ArgumentParser(description="convert a PNG that uses the colors.py palette to a .dat file (and a PNG made back from it)")
+    parser.add_argument("input", nargs="?", default="stst_10.dat.png", help="path to the PNG")
+    parser.add_argument("-q", "--quantize", action="store_true", help="map colors that aren't in the palette (anti-aliasing, JPEG artwork) to the nearest one instead of failing")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_args(args)
+
+    matching_pixels = find_matching_pixels(args.input, args.quantize)
     generate_image_from_pixel_list(matching_pixels, "test03.png")
     generate_dat_from_color_indices(matching_pixels, "test02.dat")
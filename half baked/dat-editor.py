@@ -2,12 +2,31 @@ import pygame
 import tkinter as tk
 from tkinter import colorchooser
 import sys
+import os
+import time
+from array import array
+from collections import Counter, deque
+
+# the shared .dat codec lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dat_codec
 
 pygame.init()
 
 # Colors
 BLACK = (0, 0, 0)
 
+# frame rate caps, the loop only runs fast while there is something to redraw
+ACTIVE_FPS = 60
+IDLE_FPS = 10
+
+# unsaved edits are written to the autosave file this often
+AUTOSAVE_SECONDS = 60
+AUTOSAVE_PATH = 'autosave.dat'
+
+# undo history is capped at roughly this much memory, the oldest strokes are dropped first
+UNDO_MEMORY_LIMIT = 16 * 1024 * 1024
+
 
 def get_mac_color_picker_color():
     import subprocess
@@ -23,44 +42,265 @@ def get_mac_color_picker_color():
 
     return tuple(rgb_colors)
 
+class StrokeDelta:
+    """
+    The cells changed by one stroke, stored as parallel arrays of index buffer offsets and old/new palette indices.
+    """
+    __slots__ = ('offsets', 'old_indices', 'new_indices')
+
+    def __init__(self):
+        self.offsets = array('I')
+        self.old_indices = bytearray()
+        self.new_indices = bytearray()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, offset, old_index, new_index):
+        self.offsets.append(offset)
+        self.old_indices.append(old_index)
+        self.new_indices.append(new_index)
+
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + len(self.old_indices) + len(self.new_indices)
+
+class EditHistory:
+    """
+    Undo/redo stacks of StrokeDeltas, the undo stack is a ring buffer that drops its oldest strokes once it passes memory_limit bytes.
+    """
+
+    def __init__(self, memory_limit=UNDO_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.undo_bytes = 0
+        self.stroke = None # stroke being recorded, None between strokes
+
+    def record(self, offset, old_index, new_index):
+        if self.stroke is None:
+            self.stroke = StrokeDelta()
+        self.stroke.record(offset, old_index, new_index)
+
+    def end_stroke(self):
+        if self.stroke:
+            self.undo_stack.append(self.stroke)
+            self.undo_bytes += self.stroke.nbytes()
+            self.redo_stack.clear() # a new edit means the undone strokes can't be redone anymore
+            while self.undo_bytes > self.memory_limit and len(self.undo_stack) > 1:
+                self.undo_bytes -= self.undo_stack.popleft().nbytes()
+        self.stroke = None
+
+    def undo(self):
+        self.end_stroke()
+        if not self.undo_stack:
+            return None
+        stroke = self.undo_stack.pop()
+        self.undo_bytes -= stroke.nbytes()
+        self.redo_stack.append(stroke)
+        return stroke
+
+    def redo(self):
+        self.end_stroke()
+        if not self.redo_stack:
+            return None
+        stroke = self.redo_stack.pop()
+        self.undo_stack.append(stroke)
+        self.undo_bytes += stroke.nbytes()
+        return stroke
+
+    def droppable_strokes(self):
+        # the order strokes can be given up in to free palette slots: everything that could be redone, then the oldest undo steps
+        return list(self.redo_stack) + list(self.undo_stack)
+
+    def drop(self, stroke):
+        if stroke in self.redo_stack:
+            self.redo_stack.remove(stroke)
+        else:
+            self.undo_stack.remove(stroke)
+            self.undo_bytes -= stroke.nbytes()
+
+def blank_dat(width, height):
+    # black at color index 0, every other palette entry starts out as a distinguishable color (e.g., bright magenta, jk) until it's used
+    palette_r = bytearray([255] * 256)
+    palette_g = bytearray([0] * 256)
+    palette_b = bytearray([255] * 256)
+    palette_r[0], palette_g[0], palette_b[0] = BLACK
+    return dat_codec.DatImage(width, height, palette_r, palette_g, palette_b)
+
 class PixelCanvas:
-    def __init__(self, width, height, scale):
+    def __init__(self, width, height, scale, dat=None):
         self.width = width
         self.height = height
         self.scale = scale  # Scaling factor
         self.window = pygame.display.set_mode((width * scale, height * scale))
         pygame.display.set_caption("Paint Canvas Emulator")
-        self.canvas_data = [[BLACK for _ in range(height)] for _ in range(width)]
         self.current_color = (255, 255, 255)
 
+        # the canvas is stored the same way as a .dat file: one palette index byte per cell (bottom row first) and a 256 color palette
+        self.dat = dat if dat is not None else blank_dat(width, height)
+        used_indices = set(self.dat.indices)
+        palette = self.dat.color_list()
+        self.color_indices = {}
+        for index in sorted(used_indices, reverse=True): # lowest index wins if a color is in the palette twice
+            self.color_indices[palette[index]] = index
+        # palette entries no cell uses yet, handed out as new colors get painted
+        self.free_indices = [index for index in range(255, -1, -1) if index not in used_indices]
+
+        # encoded RLE data for each row of the index buffer (bottom row first), None for rows edited since they were last encoded
+        self.row_rle = [None] * height
+        self.unsaved_edits = False
+        self.last_autosave = time.monotonic()
+
+        self.history = EditHistory()
+
+        # offscreen copy of the canvas at one pixel per cell, only the cells that change are scaled up and drawn to the window
+        self.surface = self.render_surface()
+        self.dirty_rects = [pygame.Rect(0, 0, width, height)] # in canvas cells, the whole canvas needs drawing once
+        self.clock = pygame.time.Clock()
+
     def run(self):
         running = True
         while running:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
-                elif event.type == pygame.MOUSEBUTTONDOWN:
+                elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                    # the window was covered up or restored, so all of it has to be drawn again
+                    self.dirty_rects.append(pygame.Rect(0, 0, self.width, self.height))
+                elif event.type == pygame.MOUSEBUTTONDOWN or (event.type == pygame.MOUSEMOTION and event.buttons[0]):
+                    # everything painted between pressing and releasing the mouse is one stroke for undo
                     x, y = pygame.mouse.get_pos()
                     x //= self.scale  # Adjust mouse coordinates based on scale
                     y //= self.scale
-                    self.canvas_data[y][x] = self.current_color
+                    if 0 <= x < self.width and 0 <= y < self.height:
+                        try:
+                            self.set_cell(x, y, self.current_color)
+                        except ValueError as e:
+                            # out of palette slots, the stroke just stops here rather than taking the unsaved canvas down with it
+                            print(e)
+                elif event.type == pygame.MOUSEBUTTONUP:
+                    self.history.end_stroke()
                 elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_c:
+                    if event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL and event.mod & pygame.KMOD_SHIFT:
+                        self.redo()
+                    elif event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL:
+                        self.undo()
+                    elif event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL:
+                        self.redo()
+                    elif event.key == pygame.K_c:
                         self.change_color()
+                    elif event.key == pygame.K_s and event.mod & pygame.KMOD_SHIFT:
+                        self.save_canvas_to_file('output.dat', compact='frequency')
+                        print("saved to dat with a compacted palette")
                     elif event.key == pygame.K_s:
-                        self.save_canvas_to_file(self.canvas_data, 'output.dat')
+                        self.save_canvas_to_file('output.dat')
                         print("saved to dat")
                     elif event.key == pygame.K_p:
                         self.save_to_png()
                         print("saved to png")
 
-            self.draw_canvas()
-            pygame.display.flip()
+            if self.unsaved_edits and time.monotonic() - self.last_autosave >= AUTOSAVE_SECONDS:
+                self.save_canvas_to_file(AUTOSAVE_PATH)
+                self.last_autosave = time.monotonic()
+                print("autosaved to dat")
+
+            if self.dirty_rects:
+                self.draw_canvas()
+                self.clock.tick(ACTIVE_FPS)
+            else:
+                self.clock.tick(IDLE_FPS)
+
+    @classmethod
+    def from_file(cls, file_path, scale):
+        # the decoded palette and index buffer are used as they are, no per cell conversion
+        dat = dat_codec.DatImage.load(file_path)
+        return cls(dat.width, dat.height, scale, dat)
+
+    def render_surface(self):
+        # cell rows go top to bottom on screen but bottom to top in the index buffer, so reverse the rows and let pygame apply the palette
+        rows = bytearray().join(self.dat.indices[y * self.width:(y + 1) * self.width] for y in range(self.height - 1, -1, -1))
+        indexed = pygame.image.frombuffer(bytes(rows), (self.width, self.height), 'P')
+        indexed.set_palette(self.dat.color_list())
+        return indexed.convert()
+
+    def cell_offset(self, x, y):
+        # y is counted from the top of the window, the index buffer starts at the bottom row
+        return (self.height - 1 - y) * self.width + x
+
+    def color_index(self, color):
+        if color not in self.color_indices:
+            if not self.free_indices:
+                self.reclaim_indices()
+            if not self.free_indices:
+                raise ValueError("More than 256 unique colors in canvas.")
+            index = self.free_indices.pop()
+            self.dat.palette_r[index], self.dat.palette_g[index], self.dat.palette_b[index] = color
+            self.color_indices[color] = index
+        return self.color_indices[color]
+
+    def reclaim_indices(self):
+        # palette slots are only held while a cell or an undo/redo step still uses them, so colors that were painted over get their slot back
+        # if every slot is still in use, redo steps and then the oldest undo steps are given up until one frees
+        in_use = Counter(set(self.dat.indices))
+        stroke_indices = {}
+        for stroke in self.history.droppable_strokes() + ([self.history.stroke] if self.history.stroke else []):
+            stroke_indices[id(stroke)] = set(stroke.old_indices) | set(stroke.new_indices)
+            in_use.update(stroke_indices[id(stroke)])
+
+        for stroke in self.history.droppable_strokes():
+            if len(in_use) < 256:
+                break
+            self.history.drop(stroke)
+            in_use.subtract(stroke_indices[id(stroke)])
+            in_use = +in_use # forget the indices nothing uses anymore
+
+        self.free_indices = [index for index in range(255, -1, -1) if index not in in_use]
+        self.color_indices = {color: index for color, index in self.color_indices.items() if index in in_use}
+
+    def get_cell(self, x, y):
+        index = self.dat.indices[self.cell_offset(x, y)]
+        return (self.dat.palette_r[index], self.dat.palette_g[index], self.dat.palette_b[index])
+
+    def set_cell(self, x, y, color):
+        offset = self.cell_offset(x, y)
+        old_index = self.dat.indices[offset]
+        new_index = self.color_index(color)
+        if old_index != new_index:
+            self.history.record(offset, old_index, new_index)
+            self.write_index(offset, new_index)
+
+    def write_index(self, offset, index):
+        # every change to the index buffer goes through here so the RLE cache and the screen stay in sync
+        self.dat.indices[offset] = index
+        row, x = divmod(offset, self.width)
+        y = self.height - 1 - row
+        self.row_rle[row] = None
+        self.unsaved_edits = True
+        self.surface.set_at((x, y), (self.dat.palette_r[index], self.dat.palette_g[index], self.dat.palette_b[index]))
+        self.dirty_rects.append(pygame.Rect(x, y, 1, 1))
+
+    def undo(self):
+        stroke = self.history.undo()
+        if stroke is not None:
+            # put cells back in reverse order so a cell painted twice in one stroke ends up with its original color
+            for i in range(len(stroke) - 1, -1, -1):
+                self.write_index(stroke.offsets[i], stroke.old_indices[i])
+
+    def redo(self):
+        stroke = self.history.redo()
+        if stroke is not None:
+            for i in range(len(stroke)):
+                self.write_index(stroke.offsets[i], stroke.new_indices[i])
 
     def draw_canvas(self):
-        for y in range(self.height):
-            for x in range(self.width):
-                pygame.draw.rect(self.window, self.canvas_data[y][x], (x * self.scale, y * self.scale, self.scale, self.scale))
+        # scale up and blit only the cells that changed since the last frame, then update just those parts of the window
+        window_rects = []
+        for rect in self.dirty_rects:
+            window_rect = pygame.Rect(rect.x * self.scale, rect.y * self.scale, rect.width * self.scale, rect.height * self.scale)
+            self.window.blit(pygame.transform.scale(self.surface.subsurface(rect), window_rect.size), window_rect)
+            window_rects.append(window_rect)
+        self.dirty_rects = []
+        pygame.display.update(window_rects)
 
 
     def change_color(self):
@@ -75,83 +315,38 @@ class PixelCanvas:
                 self.current_color = tuple(int(color[1][i:i+2], 16) for i in (1, 3, 5))
 
     def save_to_png(self):
-        # Create a blank surface to render the canvas
-        canvas_surface = pygame.Surface((self.width, self.height))
-        for x in range(self.width):
-            for y in range(self.height):
-                pygame.draw.rect(canvas_surface, self.canvas_data[x][y], (x, y, 1, 1))
-
-        # Save the canvas as a PNG image
-        pygame.image.save(canvas_surface, 'output.png')
-
-    def canvas_to_file_format(self, canvas_data):
-        unique_colors = [BLACK] + list(set([color for row in canvas_data for color in row if color != BLACK]))
-        if len(unique_colors) > 256:
-            raise ValueError("More than 256 unique colors in canvas.")
-
-        #paletteR = bytearray(256)
-        #paletteG = bytearray(256)
-        #paletteB = bytearray(256)
-        # Initialize palette with a distinguishable color (e.g., bright magenta, jk)
-        paletteR = bytearray([255] * 256)
-        paletteG = bytearray([0] * 256)
-        paletteB = bytearray([255] * 256)
-
-
-        for idx, color in enumerate(unique_colors):
-            paletteR[idx] = color[0]
-            paletteG[idx] = color[1]
-            paletteB[idx] = color[2]
-
-        # convert image data to palette indices
-        raster_data = bytearray()
-        prev_idx = None
-        repeat_count = 0
-
-        for y in range(self.height):
-            for x in range(self.width):
-                pixel = canvas_data[y][x]
-                idx = unique_colors.index(pixel)
-                if prev_idx is None:
-                    prev_idx = idx
-                if idx == prev_idx:
-                    repeat_count += 1
-                    if repeat_count == 256:
-                        raster_data.append(prev_idx)
-                        raster_data.append(255)
-                        repeat_count = 1
-                else:
-                    raster_data.append(prev_idx)
-                    raster_data.append(repeat_count)
-                    repeat_count = 1
-                    prev_idx = idx
-        if repeat_count > 0:
-            raster_data.append(prev_idx)
-            raster_data.append(repeat_count)
-
-        return paletteR, paletteG, paletteB, raster_data
-
-    def save_canvas_to_file(self, canvas_data, file_path):
-        paletteR, paletteG, paletteB, raster_data = self.canvas_to_file_format(canvas_data)
+        # the offscreen surface already holds the canvas at one pixel per cell
+        pygame.image.save(self.surface, 'output.png')
+
+    def canvas_to_file_format(self, compact=None):
+        # the canvas is already a palette + index buffer in the .dat layout, so there's nothing to convert
+        # unless compact ('index' or 'frequency') is given, then only the colors in use are kept and the magenta filler is dropped
+        if compact:
+            return self.dat.compacted(compact)
+        return self.dat
+
+    def encoded_rows(self):
+        # only rows edited since the last save get RLE encoded again, the rest come from the cache
+        for row, rle in enumerate(self.row_rle):
+            if rle is None:
+                indices = self.dat.indices[row * self.width:(row + 1) * self.width]
+                self.row_rle[row] = dat_codec.encode_rle(indices, self.width, 1)
+        return self.row_rle
+
+    def save_canvas_to_file(self, file_path, compact=None):
+        # header and byte swapped palette come from the shared codec, the RLE raster is spliced together from the cached rows
+        # a compacted save renumbers every cell, so it's encoded from scratch and the canvas itself keeps its palette
         with open(file_path, 'wb') as f:
-            # writing the header information
-            f.write((0).to_bytes(2, byteorder='little'))  # minX
-            f.write((0).to_bytes(2, byteorder='little'))  # minY
-            f.write((len(canvas_data[0]) - 1).to_bytes(2, byteorder='little'))  # maxX
-            f.write((len(canvas_data) - 1).to_bytes(2, byteorder='little'))  # maxY
-            f.write((1000).to_bytes(2, byteorder='little'))  # magicA
-            f.write(bytes(6))  # 6 bytes padding
-            f.write((1000).to_bytes(2, byteorder='little'))  # magicB
-            
-            # writing RBG palette data
-            f.seek(0x200)
-            f.write(paletteR)
-            f.write(paletteG)
-            f.write(paletteB)
-
-            f.write(raster_data)
+            if compact:
+                f.write(self.canvas_to_file_format(compact).to_bytes())
+            else:
+                f.write(self.dat.header_bytes() + b''.join(self.encoded_rows()))
+        self.unsaved_edits = False
 
 
 if __name__ == "__main__":
-    canvas = PixelCanvas(25, 25, 20)  # width, height, scale
+    if len(sys.argv) > 1:
+        canvas = PixelCanvas.from_file(sys.argv[1], 20)  # edit an existing .dat, scale
+    else:
+        canvas = PixelCanvas(25, 25, 20)  # width, height, scale
     canvas.run()
\ No newline at end of file
@@ -1,95 +1,38 @@
 import argparse
 from PIL import Image
 import os
+import sys
+
+# the shared .dat codec lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dat_codec
+import dat_reader
+import profiling
 
 # display the contents of a .dat file in a more human-readable format (color codes and header with coordinates)
 def parse_dat(file_path):
-    with open(file_path, 'rb') as file:
-        # Header information
-        minX = int.from_bytes(file.read(2), byteorder='little')
-        minY = int.from_bytes(file.read(2), byteorder='little')
-        maxX = int.from_bytes(file.read(2), byteorder='little')
-        maxY = int.from_bytes(file.read(2), byteorder='little')
-        
-        magicA = int.from_bytes(file.read(2), byteorder='little')
-        file.seek(6, 1)  # Skip 6 bytes to adjust for JS offset difference (0x10 vs 0x1C, not sure exactly why it is at 0x100)
-        magicB = int.from_bytes(file.read(2), byteorder='little')
-    
-        
-        if magicA != 1000 or magicB != 1000:
-            raise ValueError(f"Unknown magic numbers ({magicA}, {magicB}).")
-        
-        width = maxX - minX + 1
-        height = maxY - minY + 1
-        
-        # Palette information
-        file.seek(0x200)  # Seek to offset 0x200
-        paletteR = bytearray(file.read(0x100))
-        paletteG = bytearray(file.read(0x100))
-        paletteB = bytearray(file.read(0x100))
-        
-        # Byte swap function
-        def byte_swap(arr):
-            ret = bytearray(len(arr))
-            for i in range(0, len(arr), 2):
-                ret[i] = arr[i + 1]
-                ret[i + 1] = arr[i]
-            return ret
-        
-        paletteR = byte_swap(paletteR)
-        paletteG = byte_swap(paletteG)
-        paletteB = byte_swap(paletteB)
-
-        print("Palette:")
-        print(paletteR)
-        print()
-        print(paletteG)
-        print()
-        print(paletteB)
-        print("---")
-        
-        # go through the palette and convert the RGB values to hex
-        palette = []
-        for i in range(256):
-            red = paletteR[i]
-            green = paletteG[i]
-            blue = paletteB[i]
-            
-            # convert the RGB values to a hexadecimal color string
-            # (this is weird code but basically it formats the RGB values into a 2-character hex string), I could not write this from scratch
-            hex_color = "#{:02x}{:02x}{:02x}".format(red, green, blue)
-            
-            palette.append(hex_color)
-        
-        # Raster information
-        raster_data = bytearray(file.read())
-        raster = bytearray(width * height)
-        
-        x, y = 0, 0
-        i = 0
-        while i < len(raster_data):
-            index = raster_data[i]
-            repeat = raster_data[i + 1]
-            for r in range(repeat):
-                raster[y * width + x] = index
-                x += 1
-                if x >= width:
-                    x = 0
-                    y += 1
-                    if y >= height:
-                        break  # ran out of raster to fill
-            if y >= height:
-                break
-            i += 2
-        
+    # header, byte swapped palette and RLE raster are all decoded by the shared codec
+    dat = dat_codec.DatImage.load(file_path)
+
+    if dat.magic_a != 1000 or dat.magic_b != 1000:
+        raise ValueError(f"Unknown magic numbers ({dat.magic_a}, {dat.magic_b}).")
+
+    print("Palette:")
+    print(dat.palette_r)
+    print()
+    print(dat.palette_g)
+    print()
+    print(dat.palette_b)
+    print("---")
+
     return {
-        'width': width,
-        'height': height,
-        'palette': palette,
-        'paletteR': paletteR,
-        'paletteG': paletteG,
-        'paletteB': paletteB,
-        'data': raster
+        'width': dat.width,
+        'height': dat.height,
+        'palette': dat.hex_palette(),
+        'paletteR': dat.palette_r,
+        'paletteG': dat.palette_g,
+        'paletteB': dat.palette_b,
+        'data': dat.indices
     }
 
 
@@ -127,22 +70,12 @@ def draw_image(parsed_data):
     paletteB = parsed_data['paletteB']
     raster_data = parsed_data['data']
     
-    # create blank image and get a list of its pixels
-    img = Image.new('RGB', (width, height))
-    pixels = list(raster_data)
-    rgb_data = []
-
-    # then convert the pixels to RGB values
-    for index in pixels:
-        r = paletteR[index]
-        g = paletteG[index]
-        b = paletteB[index]
-        #inverted_color = invert_color((r, g, b))
-        #rgb_data.append(inverted_color)
-        rgb_data.append((r, g, b))
-        
+    # build a palette ("P" mode) image so PIL maps the color indices to RGB values instead of converting each pixel
+    palette = dat_codec.interleave_palette(paletteR, paletteG, paletteB)
 
-    img.putdata(rgb_data)
+    with profiling.stage('image build', pixels=width * height):
+        img = Image.frombytes('P', (width, height), bytes(raster_data))
+        img.putpalette(palette)
     img.show()
 
 
@@ -166,6 +99,17 @@ def extract_raw_colors(file_path):
         'colors': colors
     }
 
+# display the color indices of just some rows of a .dat file, only those rows get decoded so this is quick even for huge files
+# with use_index the row index is kept in a design.dat.idx sidecar so opening the same file again skips the RLE scan
+def print_rows(file_path, start_row, end_row, use_index=False):
+    with dat_reader.DatReader(file_path, use_sidecar=use_index) as reader:
+        end_row = min(end_row, reader.height)
+        with profiling.stage('read rows', rows=end_row - start_row, pixels=(end_row - start_row) * reader.width):
+            rows = reader.read_rows(start_row, end_row - start_row)
+        for row in range(start_row, end_row):
+            offset = (row - start_row) * reader.width
+            print(f"{row}: {list(rows[offset:offset + reader.width])}")
+
 def invert_color(color): # handles weirdness that I coulndt fiture out
     r, g, b = color
     return (255 - r, 255 - g, 255 - b)
@@ -174,7 +118,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", help="path to the file to be parsed")
     parser.add_argument("-f", "--format", help="format with which to display the data")
+    parser.add_argument("-r", "--rows", help="rows to display with the rows format, as start:end (row 0 is the bottom row)", default="0:1")
+    parser.add_argument("--index", action="store_true", help="keep a .idx row index sidecar next to the file so later reads of the same file jump straight to the rows")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    profiling.from_args(args)
     file_path = args.input
     format = args.format
 
@@ -184,6 +132,9 @@ if __name__ == "__main__":
     elif(format == "draw" or format == "image" or format == "canvas"):
         data = parse_dat(file_path)
         draw_image(data)
+    elif(format == "rows"):
+        start_row, end_row = (int(row) for row in args.rows.split(":"))
+        print_rows(file_path, start_row, end_row, args.index)
     elif(format == "color"):
         data = extract_raw_colors(file_path)
         print("Header:", data['header'])
@@ -0,0 +1,48 @@
+"""
+Least recently used cache capped by memory rather than by number of entries
+"""
+from collections import OrderedDict
+
+
+class MemoryLRU:
+    """
+    Dict-like LRU cache that evicts the least recently used entries once the total size of its values passes memory_limit bytes.
+    The size of each value is worked out by size_of (len by default, e.g. for bytes).
+    """
+
+    def __init__(self, memory_limit: int, size_of=len):
+        self.memory_limit = memory_limit
+        self.size_of = size_of
+        self.used_bytes = 0
+        self._entries = OrderedDict() # key -> (value, size), most recently used last
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value) -> None:
+        """
+        Add or replace an entry, then evict the oldest entries until the cache fits in memory_limit again.
+        A single value bigger than memory_limit is not kept at all.
+        """
+        if key in self._entries:
+            self.used_bytes -= self._entries.pop(key)[1]
+        size = self.size_of(value)
+        if size > self.memory_limit:
+            return
+        self._entries[key] = (value, size)
+        self.used_bytes += size
+        while self.used_bytes > self.memory_limit:
+            self.used_bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.used_bytes = 0
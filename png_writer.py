@@ -0,0 +1,70 @@
+"""
+Minimal streaming writer for palette (indexed color) PNG files
+rows are compressed and written out as they come in, so a whole image never has to be held in memory
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COLOR_TYPE_INDEXED = 3
+
+# compressed data is written out as an IDAT chunk once this much has built up
+IDAT_CHUNK_SIZE = 1 << 16
+
+
+class IndexedPngWriter:
+    """
+    Writes an 8 bit palette PNG one row at a time, rows have to be given top row first.
+    """
+
+    def __init__(self, file, width: int, height: int, rgb_palette, compress_level: int = 6):
+        """
+        :param file: A file opened for writing in binary mode.
+        :param width: Width of the image.
+        :param height: Height of the image.
+        :param rgb_palette: The palette as interleaved r, g, b bytes (up to 256 colors).
+        :param compress_level: zlib compression level, 0-9.
+        """
+        self.file = file
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = bytearray()
+
+        file.write(PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPE_INDEXED, 0, 0, 0))
+        self._write_chunk(b'PLTE', bytes(rgb_palette))
+
+    def write_row(self, row) -> None:
+        """
+        :param row: width color indices for the next row down.
+        """
+        if len(row) != self.width:
+            raise ValueError(f"Expected a row of {self.width} pixels, got {len(row)}.")
+        if self.rows_written >= self.height:
+            raise ValueError(f"All {self.height} rows have already been written.")
+
+        # each row starts with its filter type, 0 means no filtering
+        self._pending += self._compressor.compress(b'\x00')
+        self._pending += self._compressor.compress(row)
+        self.rows_written += 1
+        if len(self._pending) >= IDAT_CHUNK_SIZE:
+            self._write_chunk(b'IDAT', self._pending)
+            self._pending = bytearray()
+
+    def close(self) -> None:
+        """
+        Flush the rest of the compressed data and end the file, every row has to have been written.
+        """
+        if self.rows_written != self.height:
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written.")
+        self._pending += self._compressor.flush()
+        self._write_chunk(b'IDAT', self._pending)
+        self._write_chunk(b'IEND', b'')
+
+    def _write_chunk(self, chunk_type: bytes, data) -> None:
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
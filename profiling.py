@@ -0,0 +1,228 @@
+"""
+Opt-in per stage timing for the .dat readers and writers
+code marks its stages with `with profiling.stage('rle expand', runs=n):`, which does nothing unless profiling is turned on,
+either with the DAT_PROFILE environment variable or a script's --profile flag
+when it is on every stage records its wall time, the process's peak RSS and counters (bytes read/written, runs, pixels) and at exit a summary table
+is printed and/or a JSON trace is written (Chrome trace event format, so it opens in chrome://tracing or ui.perfetto.dev)
+exact per stage peak memory comes from tracemalloc, which slows allocation heavy stages down a lot, so it is a separate opt-in
+
+    DAT_PROFILE=1 python python-dat-viewer.py design.dat             print the summary table
+    DAT_PROFILE=trace.json python python-dat-viewer.py design.dat    also write the trace
+    DAT_PROFILE_MEMORY=1                                             also trace per stage peak memory
+"""
+import atexit
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+ENV_VAR = 'DAT_PROFILE'
+MEMORY_ENV_VAR = 'DAT_PROFILE_MEMORY'
+
+_enabled = False
+_trace_memory = False
+_trace_path = None
+_print_summary = True
+_records = [] # one dict per finished stage, in the order they finished
+_stack = [] # records of the stages currently running, innermost last
+_start = time.perf_counter()
+
+# memory fields in the records, and their summary table headings
+MEMORY_FIELDS = {'peak_rss_bytes': 'rss MiB', 'peak_memory_bytes': 'peak MiB'}
+
+
+class Stage:
+    """
+    Times one stage, used as a context manager. The record it yields is a dict that counters can be added to while the stage runs.
+    With memory tracing on, peak memory is what tracemalloc saw on top of what was allocated when the stage started, including any stages nested inside it.
+    """
+
+    def __init__(self, name: str, counters: dict):
+        self.record = {'name': name, **counters}
+
+    def __enter__(self) -> dict:
+        if not _enabled:
+            return self.record
+        if _trace_memory:
+            if _stack:
+                # resetting the peak for this stage would lose the peak the stage around it has seen so far, so that is saved first
+                parent = _stack[-1]
+                parent['_peak'] = max(parent['_peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.record['_memory'] = tracemalloc.get_traced_memory()[0]
+            self.record['_peak'] = 0
+        self.record['path'] = ' > '.join([outer['name'] for outer in _stack] + [self.record['name']])
+        self.record['_start'] = time.perf_counter()
+        _stack.append(self.record)
+        return self.record
+
+    def __exit__(self, *exc) -> None:
+        if not _enabled or not _stack or _stack[-1] is not self.record:
+            return
+        record = _stack.pop()
+        end = time.perf_counter()
+        record['start'] = record.pop('_start') - _start
+        record['seconds'] = end - _start - record['start']
+        if resource is not None:
+            record['peak_rss_bytes'] = peak_rss()
+        if _trace_memory:
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            if _stack:
+                _stack[-1]['_peak'] = max(_stack[-1]['_peak'], peak)
+            record['peak_memory_bytes'] = peak - record.pop('_memory')
+        _records.append(record)
+
+
+def peak_rss() -> int:
+    """:return: The most memory the process has held so far, in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024 # macOS reports bytes, linux kilobytes
+
+
+def stage(name: str, **counters) -> Stage:
+    """
+    :param name: What the stage does, e.g. 'rle expand'.
+    :param counters: Counters already known when the stage starts, e.g. bytes_read=len(data), more can be added to the yielded dict.
+    :return: A context manager timing the stage (nothing is recorded unless profiling is on).
+    """
+    return Stage(name, counters)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(trace_path: str = None, print_summary: bool = True, trace_memory: bool = False) -> None:
+    """
+    Turn profiling on for the rest of the run, the summary and trace are written when the interpreter exits.
+
+    :param trace_path: Where to write the JSON trace, None for no trace.
+    :param print_summary: Print the summary table to stderr at exit.
+    :param trace_memory: Record each stage's peak memory with tracemalloc (much slower).
+    """
+    global _enabled, _trace_path, _print_summary, _trace_memory
+    if trace_path:
+        _trace_path = trace_path
+    _print_summary = print_summary
+    if trace_memory and not _trace_memory:
+        _trace_memory = True
+        tracemalloc.start()
+    if not _enabled:
+        _enabled = True
+        atexit.register(finish)
+
+
+def add_arguments(parser) -> None:
+    """Add the --profile, --profile-trace and --profile-memory flags to a script's argparse parser."""
+    parser.add_argument("--profile", action="store_true", help=f"print how long each stage took (same as setting {ENV_VAR}=1)")
+    parser.add_argument("--profile-trace", help="write a JSON trace of the stages to this file")
+    parser.add_argument("--profile-memory", action="store_true", help="also record each stage's peak memory with tracemalloc (slow)")
+
+
+def from_args(args) -> None:
+    """Turn profiling on if any of the flags from add_arguments were given."""
+    if args.profile or args.profile_trace or args.profile_memory:
+        enable(args.profile_trace, trace_memory=args.profile_memory)
+
+
+def worker_initializer() -> tuple:
+    """
+    :return: (initializer, initargs) for a ProcessPoolExecutor, so its workers profile the same way as this process.
+             Workers exit without running atexit, so they have to send their stages back with take_records.
+    """
+    if not _enabled:
+        return None, ()
+    return _start_worker, (_trace_memory,)
+
+
+def _start_worker(trace_memory: bool) -> None:
+    # a forked worker starts with a copy of the parent's records, which the parent already has
+    _records.clear()
+    _stack.clear()
+    enable(print_summary=False, trace_memory=trace_memory)
+
+
+def take_records() -> list:
+    """
+    Hand over the stages recorded so far in this process and forget them, e.g. to return them from a worker to its parent.
+
+    :return: The records, with start as an absolute perf_counter time and the process id added.
+    """
+    records = [{**record, 'start': record['start'] + _start, 'pid': os.getpid()} for record in _records]
+    _records.clear()
+    return records
+
+
+def add_records(records: list) -> None:
+    """Add stages recorded in another process (from take_records) to this process's summary and trace."""
+    _records.extend({**record, 'start': record['start'] - _start} for record in records)
+
+
+def summary() -> list:
+    """
+    :return: One row per stage path (stages with the same name called from the same place are added together),
+             with calls, total seconds, largest peak RSS / peak memory and summed counters, in the order the stages first finished.
+    """
+    rows = {}
+    for record in _records:
+        row = rows.setdefault(record['path'], {'stage': record['path'], 'calls': 0, 'seconds': 0.0})
+        row['calls'] += 1
+        row['seconds'] += record['seconds']
+        for name, value in record.items():
+            if name in MEMORY_FIELDS:
+                row[name] = max(row.get(name, 0), value)
+            elif name not in ('name', 'path', 'start', 'seconds', 'pid') and isinstance(value, (int, float)):
+                row[name] = row.get(name, 0) + value
+    return list(rows.values())
+
+
+def print_summary(file=sys.stderr) -> None:
+    rows = summary()
+    if not rows:
+        return
+    memory_names = [name for name in MEMORY_FIELDS if name in rows[0]]
+    counter_names = sorted({name for row in rows for name in row} - {'stage', 'calls', 'seconds', *MEMORY_FIELDS})
+    width = max(len(row['stage']) for row in rows)
+    print(f"{'stage':<{width}} {'calls':>6} {'ms':>10}" + ''.join(f" {MEMORY_FIELDS[name]:>9}" for name in memory_names)
+          + ''.join(f" {name:>14}" for name in counter_names), file=file)
+    for row in rows:
+        print(f"{row['stage']:<{width}} {row['calls']:>6} {row['seconds'] * 1000:>10.2f}"
+              + ''.join(f" {row[name] / (1 << 20):>9.2f}" for name in memory_names)
+              + ''.join(f" {row.get(name, ''):>14}" for name in counter_names), file=file)
+
+
+def write_trace(trace_path: str) -> None:
+    """
+    Write every recorded stage as a Chrome trace 'complete' event, with the counters and peak memory as its args.
+    Stages from worker processes (see take_records) go on their own process track.
+    """
+    events = [{
+        'name': record['name'],
+        'ph': 'X',
+        'ts': record['start'] * 1e6,
+        'dur': record['seconds'] * 1e6,
+        'pid': record.get('pid', os.getpid()),
+        'tid': 0,
+        'args': {name: value for name, value in record.items() if name not in ('name', 'start', 'seconds', 'pid')}
+    } for record in _records]
+    with open(trace_path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, indent=1)
+
+
+def finish() -> None:
+    if _print_summary:
+        print_summary()
+    if _trace_path:
+        write_trace(_trace_path)
+
+
+# DAT_PROFILE=1 just prints the summary, a path ending in .json also writes the trace there
+_env_value = os.environ.get(ENV_VAR, '')
+if _env_value and _env_value != '0':
+    enable(_env_value if _env_value.lower().endswith('.json') else None, trace_memory=os.environ.get(MEMORY_ENV_VAR, '0') != '0')
@@ -3,82 +3,91 @@ Read in .dat files for shima knitting machines to image format, but more than th
 some useful .dat file structure info is in the dat_info.md file
 by Jack Hester
 """
+import argparse
+import os
+
 from PIL import Image
 
-def byte_swap(arr): # TODO: put this in a shared file because grid generator uses
-    ret = bytearray(len(arr))
-    for i in range(0, len(arr), 2):
-        ret[i] = arr[i+1]
-        ret[i+1] = arr[i]
-    return ret
+import profiling
+from dat_codec import DatImage
+from dat_reader import DatReader, stream_to_png
 
-def read_short(file, offset):
-    file.seek(offset)
-    return int.from_bytes(file.read(2), 'little')
+# formats that can store a palette image as it is, anything else (JPEG, WEBP, ...) gets an RGB copy
+PALETTE_FORMATS = ('PNG', 'GIF', 'BMP', 'TIFF')
 
-def read_byte(file, offset):
-    file.seek(offset)
-    return int.from_bytes(file.read(1), 'little')
+def decode_dat_to_image(file_path, output_path=None, format=None, scale=1, quiet=False, show=False):
+    # header, palette (byte swapped from little endian) and RLE raster are all read by the shared codec
+    # nothing is launched unless show is set, so this can run on headless servers, quiet skips the magic number printing
+    dat = DatImage.load(file_path)
 
-def decode_dat_to_image(file_path):
-    with open(file_path, 'rb') as file:
-        # canvas dimensions come from header
-        min_x = read_short(file, 0x000)
-        min_y = read_short(file, 0x002)
-        max_x = read_short(file, 0x004)
-        max_y = read_short(file, 0x006)
+    if(dat.magic_a != 1000 or dat.magic_b!=1000):
+        print("something is wrong with the magic nubmers, check your file")
+    elif not quiet:
+        print(f'magic_A: {dat.magic_a}, magic_B: {dat.magic_b}')
 
-        magic_A = read_short(file, 0x008)
-        magic_B = read_short(file, 0x010)
-        print(f'magic_A: {magic_A}, magic_B: {magic_B}')
-        if(magic_A != 1000 or magic_B!=1000):
-            print("something is wrong with the magic nubmers, check your file")
-        
-        width = max_x - min_x + 1
-        height = max_y - min_y + 1
- 
-        
-        # get colors
-        #colors = []
-        #max_colors = 256 # naively assume that there are 256 colors, but there may be less
+    if output_path is None:
+        output_path = file_path + '.' + (format or 'png').lower()
 
-        file.seek(0x200) # seek to beginning of colors
-        # byteswap is used to convert from little endian to big endian for each r g b value
-        red_values = byte_swap(file.read(0x100))
-        green_values = byte_swap(file.read(0x100))
-        blue_values = byte_swap(file.read(0x100))
+    img = dat.to_image()
+    if scale != 1:
+        # nearest neighbour keeps every stitch a solid block of color
+        with profiling.stage('scale', pixels=dat.width * dat.height * scale * scale):
+            img = img.resize((dat.width * scale, dat.height * scale), Image.Resampling.NEAREST)
+    save_format = format or Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+    if save_format is not None and save_format.upper() not in PALETTE_FORMATS:
+        img = img.convert('RGB')
+    with profiling.stage('image save') as stage:
+        img.save(output_path, format=format)
+        stage['bytes_written'] = os.path.getsize(output_path)
+    if show:
+        img.show()
+    return output_path
 
-        #red_values = file.read(0x100)
-        #green_values = file.read(0x100)
-        #blue_values =file.read(0x100)
+def decode_dat_rows_to_image(file_path, start_row, end_row, use_index=True, show=False):
+    # only decode rows start_row up to (not including) end_row, row 0 is the bottom row
+    # with use_index the row index is kept in a design.dat.idx sidecar so reopening the same file jumps straight to the rows
+    with DatReader(file_path, use_sidecar=use_index) as reader:
+        end_row = min(end_row, reader.height)
+        with profiling.stage('read rows', rows=max(end_row - start_row, 0), pixels=max(end_row - start_row, 0) * reader.width):
+            region = reader.read_region(0, start_row, reader.width, end_row - start_row)
+        img = region.to_image()
 
-        #colors.reverse()
-        #print(colors)
-        
-        img = Image.new('RGB', (width, height))
-        pixels = img.load()
-        
-        # fill in the image based on the data starting at 0x600
-        x, y = 0, 0  # start from the bottom-left corner
-        offset = 0x600  # starting offset for raster data (RLE)
-        while y < height:
-            color_index = read_byte(file, offset)
-            repeat_count = read_byte(file, offset + 1)
-            
-            for _ in range(repeat_count):
-                pixels[x, height - 1 - y] = (red_values[color_index], green_values[color_index], blue_values[color_index])# adjust y index to start from the bottom so it's a little less weird to think about
-                x += 1
-                if x >= width:
-                    x = 0
-                    y += 1
-                    if y >= height:
-                        break
-            
-            offset += 2 # number of bytes read per color = 2
-        
-        img.save(file_path + '.png')
+    with profiling.stage('image save'):
+        img.save(f'{file_path}.rows{start_row}-{end_row}.png')
+    if show:
         img.show()
 
+def stream_dat_to_png(file_path, output_path=None):
+    # decode and write one row at a time straight into a palette PNG, so memory stays at a few rows no matter how tall the design is
+    # same picture as decode_dat_to_image at scale 1, just without ever holding the whole thing
+    if output_path is None:
+        output_path = file_path + '.png'
+    stream_to_png(file_path, output_path)
+    return output_path
+
 # main
 if __name__ == '__main__':
-    decode_dat_to_image('test02.dat')
+    parser = argparse.ArgumentParser(description="render a .dat file to an image")
+    parser.add_argument("input", nargs="?", default="test02.dat", help="path to the .dat file")
+    parser.add_argument("-o", "--output", help="path to write the image to (default: the input path + .png)")
+    parser.add_argument("-f", "--format", help="image format to write, e.g. PNG, BMP, WEBP (default: from the output extension)")
+    parser.add_argument("-s", "--scale", type=int, default=1, help="scale each stitch up to this many pixels")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print the magic numbers")
+    parser.add_argument("--show", action="store_true", help="open the image in a viewer after saving it")
+    parser.add_argument("--tiles", action="store_true", help="open the design in the pan/zoom tile viewer instead of saving an image")
+    parser.add_argument("--stream", action="store_true", help="write the PNG a few rows at a time, for designs too tall to decode in one go (PNG only, no scaling)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_args(args)
+
+    if args.tiles:
+        # the tile viewer needs pygame, so it's only imported when asked for
+        from tile_viewer import view_dat
+        view_dat(args.input)
+    elif args.stream:
+        output_format = args.format or Image.registered_extensions().get(os.path.splitext(args.output or args.input + '.png')[1].lower())
+        if args.scale != 1 or (output_format or '').upper() != 'PNG' or args.show:
+            parser.error("--stream only writes PNGs at scale 1 and can't --show them")
+        stream_dat_to_png(args.input, args.output)
+    else:
+        decode_dat_to_image(args.input, args.output, args.format, args.scale, args.quiet, args.show)
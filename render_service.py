@@ -0,0 +1,342 @@
+"""
+Small local HTTP service that renders .dat files to PNGs, thumbnails and palette JSON
+results are keyed on a hash of the file contents (so renamed or copied files hit the cache and edited ones don't), kept in a memory capped LRU
+with a size capped second tier on disk, and decodes run in a process pool so one big file doesn't hold up every other request
+
+    GET  /render?path=designs/a.dat&format=png          render a file under --root
+    POST /render?format=thumbnail&size=128              render the .dat file sent as the request body
+    GET  /stats                                         cache hit counts
+format is png (default), thumbnail or palette
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from dat_codec import DatImage
+from dat_validate import validate_bytes
+from lru_cache import MemoryLRU
+
+DEFAULT_PORT = 8765
+MEMORY_LIMIT = 128 * 1024 * 1024 # bytes of rendered results kept in memory
+DISK_LIMIT = 1024 * 1024 * 1024 # bytes of rendered results kept in the disk cache
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+THUMBNAIL_SIZE = 256
+MAX_THUMBNAIL_SIZE = 4096
+MAX_PIXELS = 64 * 1024 * 1024 # stitches a file's header can claim, the whole canvas gets allocated before the runs are expanded
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'thumbnail': 'image/png',
+    'palette': 'application/json'
+}
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """An error to send back to the client, with its HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+    def __reduce__(self):
+        # raised in worker processes, so it has to survive being pickled back
+        return RequestError, (self.status, str(self))
+
+
+def render(data: bytes, kind: str, size: int) -> bytes:
+    """
+    Render a .dat file's contents, run in a worker process.
+    Only files that can't be decoded (bad header bounds or magic numbers, cut off palette) or whose canvas is bigger than MAX_PIXELS
+    are refused, runs that overshoot or don't fill the canvas are rendered the same way the viewer does.
+
+    :param data: The whole .dat file.
+    :param kind: 'png' for the full image, 'thumbnail' for one that fits in size x size, 'palette' for the palette and stitch counts as JSON.
+    :param size: Thumbnail width and height limit, None for the other kinds.
+    :return: The PNG or JSON bytes.
+    """
+    report = validate_bytes(data)
+    if not report['readable']:
+        raise RequestError(422, '; '.join(report['errors']))
+    # a few hundred bytes can claim a 65535x65535 canvas, so the size is checked before anything gets allocated for it
+    if report['pixel_count'] > MAX_PIXELS:
+        raise RequestError(422, f"{report['width']}x{report['height']} is {report['pixel_count']} stitches, the limit is {MAX_PIXELS}")
+
+    dat = DatImage.from_bytes(data)
+    if kind == 'palette':
+        counts = dat.color_counts()
+        hex_palette = dat.hex_palette()
+        return json.dumps({
+            'width': dat.width,
+            'height': dat.height,
+            'palette': hex_palette,
+            'used': [{'index': index, 'color': hex_palette[index], 'stitches': int(counts[index])} for index in range(256) if counts[index]]
+        }).encode()
+
+    img = dat.to_image()
+    if kind == 'thumbnail':
+        # box filtering averages the stitches that fall into each thumbnail pixel, so fine patterns don't alias
+        img = img.convert('RGB')
+        img.thumbnail((size, size), Image.Resampling.BOX)
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+
+def read_and_hash(file_path: str) -> tuple:
+    """:return: (file contents, sha256 hex digest of them)."""
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def read_cached(cache_path: str):
+    """:return: The contents of a disk cache file, or None if it isn't there. A hit bumps the file's mtime, which prune_cache goes by."""
+    try:
+        with open(cache_path, 'rb') as file:
+            body = file.read()
+        os.utime(cache_path)
+        return body
+    except OSError:
+        return None
+
+
+def write_cached(cache_path: str, body: bytes) -> None:
+    """Write a disk cache file, through a temporary name so a half written file is never read back. Failures are ignored."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(body)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+
+
+def prune_cache(cache_dir: str, disk_limit: int) -> int:
+    """
+    Delete the least recently used disk cache files (oldest mtime first) until the cache fits in disk_limit bytes.
+
+    :return: Bytes the cache takes up afterwards.
+    """
+    entries = []
+    for directory, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            if file_name.endswith('.tmp'):
+                continue # still being written
+            path = os.path.join(directory, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    used_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if used_bytes <= disk_limit:
+            break
+        try:
+            os.remove(path)
+            used_bytes -= size
+        except OSError:
+            pass
+    return used_bytes
+
+
+class RenderService:
+    """
+    The cache tiers and worker pool behind the HTTP handler: memory LRU first, then the disk cache, then a decode in the pool.
+    Requests for a result that is already being rendered wait on that render instead of starting another.
+    """
+
+    def __init__(self, root: str, cache_dir: str, memory_limit: int = MEMORY_LIMIT, workers: int = None, disk_limit: int = DISK_LIMIT):
+        """
+        :param root: Only files under this directory can be rendered by path.
+        :param cache_dir: Directory for the on-disk cache tier.
+        :param memory_limit: Bytes of results to keep in memory.
+        :param disk_limit: Bytes of results to keep in the disk cache, the least recently used files are deleted past this.
+        :param workers: Number of decode processes, None for one per CPU.
+        """
+        self.root = os.path.realpath(root)
+        self.cache_dir = cache_dir
+        self.memory = MemoryLRU(memory_limit)
+        self.disk_limit = disk_limit
+        self.disk_bytes = None # size of the disk cache, None until it's been scanned once
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.in_flight = {} # cache key -> future of a render that hasn't finished yet
+        self.counts = {'memory': 0, 'disk': 0, 'render': 0, 'waited': 0, 'not_modified': 0}
+
+    @staticmethod
+    def cache_key(digest: str, kind: str, size: int) -> str:
+        """:return: The key a result is cached under, one per file contents and representation (also used as its ETag)."""
+        return f'{digest}-{kind}' + (f'-{size}' if kind == 'thumbnail' else '')
+
+    def cache_path(self, key: str, kind: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ('.json' if kind == 'palette' else '.png'))
+
+    def resolve(self, file_path: str) -> str:
+        """:return: The real path of a requested file, which has to be inside root."""
+        real_path = os.path.realpath(os.path.join(self.root, file_path))
+        if os.path.commonpath([self.root, real_path]) != self.root:
+            raise RequestError(403, f"{file_path} is outside the served directory")
+        if not os.path.isfile(real_path):
+            raise RequestError(404, f"{file_path} not found")
+        return real_path
+
+    async def get(self, data: bytes, key: str, kind: str, size: int) -> tuple:
+        """
+        :param key: The result's cache_key.
+        :return: (result bytes, where it came from: 'memory', 'disk', 'render' or 'waited').
+        """
+        body = self.memory.get(key)
+        if body is not None:
+            return body, 'memory'
+
+        if key in self.in_flight:
+            return await asyncio.shield(self.in_flight[key]), 'waited'
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[key] = future
+        try:
+            cache_path = self.cache_path(key, kind)
+            body = await loop.run_in_executor(None, read_cached, cache_path)
+            source = 'disk'
+            if body is None:
+                body = await loop.run_in_executor(self.pool, render, data, kind, size)
+                source = 'render'
+                await loop.run_in_executor(None, write_cached, cache_path, body)
+                # the directory is only walked when the running total says the cache has grown past its limit
+                if self.disk_bytes is not None:
+                    self.disk_bytes += len(body)
+                if self.disk_bytes is None or self.disk_bytes > self.disk_limit:
+                    self.disk_bytes = await loop.run_in_executor(None, prune_cache, self.cache_dir, self.disk_limit)
+            self.memory.put(key, body)
+            future.set_result(body)
+            return body, source
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # mark it retrieved, otherwise asyncio complains when nobody else was waiting on it
+            raise
+        finally:
+            del self.in_flight[key]
+
+    async def handle_render(self, method: str, query: dict, body: bytes, if_none_match: str = None) -> tuple:
+        """
+        :param if_none_match: The request's If-None-Match header, a match is answered with a 304 without rendering anything.
+        :return: (status, content type, body, extra headers) for a /render request.
+        """
+        kind = query.get('format', ['png'])[0]
+        if kind not in CONTENT_TYPES:
+            raise RequestError(400, f"format must be one of {', '.join(CONTENT_TYPES)}")
+        # size only means something for thumbnails, the other formats ignore it
+        size = None
+        if kind == 'thumbnail':
+            try:
+                size = int(query.get('size', [THUMBNAIL_SIZE])[0])
+            except ValueError:
+                raise RequestError(400, "size must be a number")
+            if not 1 <= size <= MAX_THUMBNAIL_SIZE:
+                raise RequestError(400, f"size must be between 1 and {MAX_THUMBNAIL_SIZE}")
+
+        loop = asyncio.get_running_loop()
+        if method == 'POST':
+            data = body
+            digest = await loop.run_in_executor(None, lambda: hashlib.sha256(data).hexdigest())
+        elif 'path' in query:
+            data, digest = await loop.run_in_executor(None, read_and_hash, self.resolve(query['path'][0]))
+        else:
+            raise RequestError(400, "GET /render needs a path, or POST the .dat file")
+
+        key = self.cache_key(digest, kind, size)
+        etag = f'"{key}"'
+        if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]):
+            self.counts['not_modified'] += 1
+            return 304, CONTENT_TYPES[kind], b'', {'ETag': etag}
+
+        result, source = await self.get(data, key, kind, size)
+        self.counts[source] += 1
+        return 200, CONTENT_TYPES[kind], result, {'X-Cache': source, 'ETag': etag}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve one HTTP request per connection."""
+        extra_headers = {}
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) != 3:
+                return
+            method, target, _ = request_line
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            content_length = int(headers.get('content-length', 0) or 0)
+            if content_length > MAX_UPLOAD_BYTES:
+                raise RequestError(413, f"uploads are limited to {MAX_UPLOAD_BYTES} bytes")
+            body = await reader.readexactly(content_length) if content_length else b''
+
+            url = urlsplit(target)
+            if url.path == '/render' and method in ('GET', 'POST'):
+                status, content_type, response, extra_headers = await self.handle_render(method, parse_qs(url.query), body,
+                                                                                         headers.get('if-none-match'))
+            elif url.path == '/stats' and method == 'GET':
+                status, content_type = 200, CONTENT_TYPES['palette']
+                response = json.dumps({**self.counts, 'memory_entries': len(self.memory), 'memory_bytes': self.memory.used_bytes,
+                                       'disk_bytes': self.disk_bytes}).encode()
+            elif url.path in ('/render', '/stats'):
+                raise RequestError(405, f"{method} not allowed on {url.path}")
+            else:
+                raise RequestError(404, f"{url.path} not found")
+        except RequestError as e:
+            status, content_type, response = e.status, 'text/plain', str(e).encode()
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, content_type, response = 400, 'text/plain', str(e).encode()
+        except Exception as e:
+            status, content_type, response = 500, 'text/plain', f"{type(e).__name__}: {e}".encode()
+
+        head = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Type: {content_type}", f"Content-Length: {len(response)}", "Connection: close"]
+        head += [f"{name}: {value}" for name, value in extra_headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"serving .dat renders from {self.root} on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="local HTTP service that renders .dat files to PNG, thumbnails and palette JSON")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("-r", "--root", default=".", help="directory files can be requested from by path")
+    parser.add_argument("-c", "--cache-dir", default=".render_cache", help="directory for the on-disk cache")
+    parser.add_argument("-m", "--memory-mb", type=int, default=MEMORY_LIMIT // (1024 * 1024), help="memory for cached results in MiB")
+    parser.add_argument("-d", "--disk-mb", type=int, default=DISK_LIMIT // (1024 * 1024), help="disk space for cached results in MiB")
+    parser.add_argument("-w", "--workers", type=int, help="number of decode processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    service = RenderService(args.root, args.cache_dir, args.memory_mb * 1024 * 1024, args.workers, args.disk_mb * 1024 * 1024)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.pool.shutdown()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import numpy as np
+
+# the scripts live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dat_transform import RunImage
+
+BLUE = (0, 0, 255)
+RED = (255, 0, 0)
+
+
+def solid_rows(width, height, colors):
+    # one run per row, row n gets colors[n % len(colors)]
+    return [(np.array([colors[row % len(colors)]], dtype=np.uint8), np.array([width], dtype=np.int64)) for row in range(height)]
+
+
+def test_paste_colors_dont_reuse_unused_entries():
+    # base uses entries 0-199 (all grey), entry 200 holds red but nothing uses it
+    palette = [(128, 128, 128)] * 256
+    palette[200] = RED
+    base = RunImage(4, 200, *zip(*palette), solid_rows(4, 200, list(range(200))))
+
+    # pasted design: blue at 0, red at 1
+    other_palette = [(0, 0, 0)] * 256
+    other_palette[0], other_palette[1] = BLUE, RED
+    other = RunImage(2, 2, *zip(*other_palette), solid_rows(2, 2, [0, 1]))
+
+    result = base.paste(other, 0, 0)
+    palette = list(zip(result.palette_r, result.palette_g, result.palette_b))
+    assert palette[int(result.rows[0][0][0])] == BLUE
+    assert palette[int(result.rows[1][0][0])] == RED
+
+
+def test_paste_reuses_colors_the_base_already_uses():
+    palette = [(0, 0, 0)] * 256
+    palette[3] = palette[5] = RED
+    base = RunImage(2, 2, *zip(*palette), solid_rows(2, 2, [3, 5]))
+
+    other_palette = [(0, 0, 0)] * 256
+    other_palette[7] = RED
+    other = RunImage(1, 1, *zip(*other_palette), solid_rows(1, 1, [7]))
+
+    translation = base.add_palette_colors(other)
+    assert translation[7] == 3
@@ -0,0 +1,245 @@
+"""
+Pan/zoom viewer for designs too big to fit on screen
+the decoded index raster is turned into a pyramid of half size levels, each cut into tiles, and only the tiles that are
+on screen get rendered (rendered tiles are kept in a memory capped LRU), so panning and zooming cost about the same for any design size
+"""
+import argparse
+import math
+
+import numpy as np
+import pygame
+
+from dat_codec import DatImage
+from lru_cache import MemoryLRU
+
+TILE_SIZE = 256
+TILE_CACHE_LIMIT = 64 * 1024 * 1024 # bytes of rendered tiles to keep around
+
+WINDOW_SIZE = (1024, 768)
+ZOOM_STEP = 1.25
+PAN_STEP = 64 # screen pixels per arrow key press
+
+
+def downsample_nearest(grid: np.ndarray) -> np.ndarray:
+    """:return: Half size grid keeping the top-left stitch of every 2x2 block."""
+    return grid[::2, ::2].copy()
+
+
+def downsample_majority(grid: np.ndarray) -> np.ndarray:
+    """:return: Half size grid keeping the most common color of every 2x2 block (ties go to the top-left stitch)."""
+    # odd sizes are padded by repeating the last row/column so every block is complete
+    padded = np.pad(grid, ((0, grid.shape[0] % 2), (0, grid.shape[1] % 2)), mode='edge')
+    a, b = padded[0::2, 0::2], padded[0::2, 1::2]
+    c, d = padded[1::2, 0::2], padded[1::2, 1::2]
+    # a wins if it shows up twice, otherwise b or c wins if they do, and if all four differ a is kept
+    return np.where((a == b) | (a == c) | (a == d), a,
+                    np.where((b == c) | (b == d), b,
+                             np.where(c == d, c, a)))
+
+
+DOWNSAMPLERS = {
+    'nearest': downsample_nearest,
+    'majority': downsample_majority
+}
+
+
+class TilePyramid:
+    """
+    Multi resolution copies of a design's color index grid, level 0 is full size and each level after it is half the size of the one before,
+    down to the level that fits in a single tile.
+    """
+
+    def __init__(self, grid: np.ndarray, tile_size: int = TILE_SIZE, method: str = 'nearest'):
+        """
+        :param grid: 2-D uint8 array of color indices, first row is the top of the image.
+        :param tile_size: Width and height of each tile in stitches of its level.
+        :param method: How levels are downsampled, 'nearest' or 'majority'.
+        """
+        self.tile_size = tile_size
+        self.levels = [grid]
+        while max(self.levels[-1].shape) > tile_size:
+            self.levels.append(DOWNSAMPLERS[method](self.levels[-1]))
+
+    @classmethod
+    def from_dat(cls, dat: DatImage, tile_size: int = TILE_SIZE, method: str = 'nearest') -> 'TilePyramid':
+        # the index buffer starts at the bottom row, flip it so the first row is the top of the image
+        grid = np.frombuffer(dat.indices, dtype=np.uint8).reshape(dat.height, dat.width)[::-1]
+        return cls(grid, tile_size, method)
+
+    def level_size(self, level: int) -> tuple:
+        """:return: (width, height) of a level in stitches."""
+        height, width = self.levels[level].shape
+        return width, height
+
+    def tile_count(self, level: int) -> tuple:
+        """:return: (columns, rows) of tiles on a level."""
+        width, height = self.level_size(level)
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def tile(self, level: int, tile_x: int, tile_y: int) -> np.ndarray:
+        """:return: The color indices of one tile, tiles on the right and bottom edges can be smaller than tile_size."""
+        return self.levels[level][tile_y * self.tile_size:(tile_y + 1) * self.tile_size,
+                                  tile_x * self.tile_size:(tile_x + 1) * self.tile_size]
+
+
+class TileViewer:
+    """
+    pygame window showing a TilePyramid, arrow keys or dragging pans and the mouse wheel (or +/-) zooms around the cursor.
+    """
+
+    def __init__(self, pyramid: TilePyramid, palette: list, window_size: tuple = WINDOW_SIZE, cache_limit: int = TILE_CACHE_LIMIT):
+        """
+        :param pyramid: The tiles to show.
+        :param palette: 256 (r, g, b) tuples in color index order.
+        :param window_size: Size of the window in screen pixels.
+        :param cache_limit: Bytes of rendered tiles to keep in the LRU.
+        """
+        pygame.init()
+        self.window = pygame.display.set_mode(window_size)
+        pygame.display.set_caption("Dat Tile Viewer")
+
+        self.pyramid = pyramid
+        self.palette = palette
+        self.tiles = MemoryLRU(cache_limit, size_of=lambda surface: surface.get_width() * surface.get_height() * surface.get_bytesize())
+
+        # zoom is screen pixels per stitch, start zoomed so the whole design fits in the window
+        width, height = pyramid.level_size(0)
+        self.zoom = min(window_size[0] / width, window_size[1] / height)
+        self.offset_x = 0.0 # design coordinates (in stitches) of the top-left corner of the window
+        self.offset_y = 0.0
+        self.needs_redraw = True
+
+    def rendered_tile(self, level: int, tile_x: int, tile_y: int):
+        """:return: A pygame surface of one tile, from the LRU if it has been rendered before."""
+        key = (level, tile_x, tile_y)
+        surface = self.tiles.get(key)
+        if surface is None:
+            indices = np.ascontiguousarray(self.pyramid.tile(level, tile_x, tile_y))
+            indexed = pygame.image.frombuffer(indices.tobytes(), (indices.shape[1], indices.shape[0]), 'P')
+            indexed.set_palette(self.palette)
+            surface = indexed.convert()
+            self.tiles.put(key, surface)
+        return surface
+
+    def visible_level(self) -> int:
+        # use the smallest level that still has at least one stitch per screen pixel
+        level = int(math.floor(math.log2(1 / self.zoom))) if self.zoom < 1 else 0
+        return min(max(level, 0), len(self.pyramid.levels) - 1)
+
+    def draw(self) -> None:
+        self.window.fill((40, 40, 40))
+        level = self.visible_level()
+        level_scale = 2 ** level # stitches of level 0 per stitch of this level
+        tile_stitches = self.pyramid.tile_size * level_scale # level 0 stitches covered by one tile
+        columns, rows = self.pyramid.tile_count(level)
+        window_width, window_height = self.window.get_size()
+
+        # only the tiles overlapping the window are rendered and drawn
+        first_x = max(int(self.offset_x // tile_stitches), 0)
+        first_y = max(int(self.offset_y // tile_stitches), 0)
+        last_x = min(int((self.offset_x + window_width / self.zoom) // tile_stitches), columns - 1)
+        last_y = min(int((self.offset_y + window_height / self.zoom) // tile_stitches), rows - 1)
+        for tile_y in range(first_y, last_y + 1):
+            for tile_x in range(first_x, last_x + 1):
+                surface = self.rendered_tile(level, tile_x, tile_y)
+                # round both edges so neighbouring tiles meet without gaps
+                left = round((tile_x * tile_stitches - self.offset_x) * self.zoom)
+                top = round((tile_y * tile_stitches - self.offset_y) * self.zoom)
+                right = round((tile_x * tile_stitches + surface.get_width() * level_scale - self.offset_x) * self.zoom)
+                bottom = round((tile_y * tile_stitches + surface.get_height() * level_scale - self.offset_y) * self.zoom)
+                self.blit_clipped(surface, pygame.Rect(left, top, right - left, bottom - top))
+
+        pygame.display.flip()
+        self.needs_redraw = False
+
+    def blit_clipped(self, surface, screen_rect) -> None:
+        # when zoomed in a tile can be far bigger than the window, so only the part of it that is on screen gets scaled
+        visible = screen_rect.clip(self.window.get_rect())
+        if visible.width <= 0 or visible.height <= 0:
+            return
+        x_scale = screen_rect.width / surface.get_width()
+        y_scale = screen_rect.height / surface.get_height()
+        source_left = int((visible.left - screen_rect.left) / x_scale)
+        source_top = int((visible.top - screen_rect.top) / y_scale)
+        source_right = min(math.ceil((visible.right - screen_rect.left) / x_scale), surface.get_width())
+        source_bottom = min(math.ceil((visible.bottom - screen_rect.top) / y_scale), surface.get_height())
+
+        left = screen_rect.left + round(source_left * x_scale)
+        top = screen_rect.top + round(source_top * y_scale)
+        right = screen_rect.left + round(source_right * x_scale)
+        bottom = screen_rect.top + round(source_bottom * y_scale)
+        source = surface.subsurface((source_left, source_top, source_right - source_left, source_bottom - source_top))
+        self.window.blit(pygame.transform.scale(source, (right - left, bottom - top)), (left, top))
+
+    def zoom_at(self, factor: float, screen_x: int, screen_y: int) -> None:
+        # keep the stitch under the cursor in place while zooming
+        design_x = self.offset_x + screen_x / self.zoom
+        design_y = self.offset_y + screen_y / self.zoom
+        self.zoom = min(max(self.zoom * factor, 1 / 2 ** (len(self.pyramid.levels) + 1)), 64)
+        self.offset_x = design_x - screen_x / self.zoom
+        self.offset_y = design_y - screen_y / self.zoom
+        self.needs_redraw = True
+
+    def pan(self, screen_dx: float, screen_dy: float) -> None:
+        self.offset_x += screen_dx / self.zoom
+        self.offset_y += screen_dy / self.zoom
+        self.needs_redraw = True
+
+    def run(self) -> None:
+        clock = pygame.time.Clock()
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                    self.needs_redraw = True
+                elif event.type == pygame.MOUSEWHEEL:
+                    self.zoom_at(ZOOM_STEP ** event.y, *pygame.mouse.get_pos())
+                elif event.type == pygame.MOUSEMOTION and event.buttons[0]:
+                    self.pan(-event.rel[0], -event.rel[1])
+                elif event.type == pygame.KEYDOWN:
+                    center = (self.window.get_width() // 2, self.window.get_height() // 2)
+                    if event.key in (pygame.K_PLUS, pygame.K_EQUALS):
+                        self.zoom_at(ZOOM_STEP, *center)
+                    elif event.key == pygame.K_MINUS:
+                        self.zoom_at(1 / ZOOM_STEP, *center)
+                    elif event.key == pygame.K_LEFT:
+                        self.pan(-PAN_STEP, 0)
+                    elif event.key == pygame.K_RIGHT:
+                        self.pan(PAN_STEP, 0)
+                    elif event.key == pygame.K_UP:
+                        self.pan(0, -PAN_STEP)
+                    elif event.key == pygame.K_DOWN:
+                        self.pan(0, PAN_STEP)
+                    elif event.key in (pygame.K_q, pygame.K_ESCAPE):
+                        running = False
+
+            if self.needs_redraw:
+                self.draw()
+            clock.tick(60)
+        pygame.quit()
+
+
+def view_dat(file_path: str, method: str = 'nearest', tile_size: int = TILE_SIZE, cache_limit: int = TILE_CACHE_LIMIT) -> None:
+    """
+    Open a .dat file in the tile viewer.
+
+    :param file_path: Path to the .dat file.
+    :param method: How zoomed out levels are downsampled, 'nearest' or 'majority'.
+    :param tile_size: Tile width and height in stitches.
+    :param cache_limit: Bytes of rendered tiles to keep in memory.
+    """
+    dat = DatImage.load(file_path)
+    TileViewer(TilePyramid.from_dat(dat, tile_size, method), dat.color_list(), cache_limit=cache_limit).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="pan/zoom viewer for large .dat files")
+    parser.add_argument("input", help="path to the .dat file")
+    parser.add_argument("-m", "--method", choices=sorted(DOWNSAMPLERS), default="nearest", help="how zoomed out levels pick a stitch color")
+    parser.add_argument("-t", "--tile-size", type=int, default=TILE_SIZE, help="tile width and height in stitches")
+    parser.add_argument("-c", "--cache-mb", type=int, default=TILE_CACHE_LIMIT // (1024 * 1024), help="memory for rendered tiles in MiB")
+    args = parser.parse_args()
+
+    view_dat(args.input, args.method, args.tile_size, args.cache_mb * 1024 * 1024)